@@ -42,8 +42,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chs.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'chs.middleware.AccountMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -55,7 +57,8 @@ ROOT_URLCONF = 'chess_openings.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django templates, with render times recorded for /metrics.
+        'BACKEND': 'chs.metrics.TimedTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -88,6 +91,51 @@ DATABASES = {
 }
 
 
+# Encoding of game and opening moves, either 'wide' (two bytes per move)
+# or 'compact' (one byte per move). Existing rows must be converted with
+# `manage.py reencode_moves` when changing it.
+CHS_MOVE_ENCODING = 'wide'
+
+# Number of plies for which the opening explorer statistics are kept up to
+# date. Deeper positions are aggregated from the games on request.
+CHS_EXPLORER_DEPTH = 20
+
+# Cache of the rendered detail pages, invalidated by object versions.
+# A 'django.core.cache.backends.filebased.FileBasedCache' backend shares it
+# between processes.
+# The 'shared' cache keeps values all processes must agree on, such as the
+# generation of the game statistics. Its table is created after migrations.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chess-openings',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'chs_cache',
+    },
+}
+
+# Lifetime of cached pages, in seconds.
+CHS_PAGE_CACHE_TIMEOUT = 3600
+
+# Requests slower than this many seconds, or running more than this many
+# queries, are logged by the 'chs.middleware' logger with their slowest
+# statements, when their queries are sampled. None disables a threshold.
+CHS_SLOW_REQUEST_SECONDS = 1.0
+CHS_SLOW_REQUEST_QUERIES = 100
+CHS_SLOW_REQUEST_STATEMENTS = 5
+
+# Fraction of the requests whose SQL queries are counted in the metrics.
+# Django 1.11 has no execute wrapper, queries are captured with the debug
+# cursor, which formats every statement.
+CHS_METRICS_SQL_SAMPLE_RATE = 0.1
+
+# Addresses allowed to read the request metrics at /metrics, typically the
+# Prometheus server.
+CHS_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
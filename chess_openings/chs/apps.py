@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ChsConfig(AppConfig):
     name = 'chs'
+
+    def ready(self):
+        from . import schema
+        post_migrate.connect(schema.create_schema, sender=self)
@@ -0,0 +1,63 @@
+from functools import lru_cache
+from . import pgn
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def move_array():
+    """`pgn.move_table` as a NumPy object array."""
+    table = pgn.move_table()
+    res = np.empty(len(table), dtype=object)
+    for code, move in enumerate(table):
+        res[code] = move
+    return res
+
+
+def code_arrays(buffers):
+    """Concatenate two bytes encoded games into an array of move codes.
+
+    Returns (codes, offsets), where the moves of game i are
+    codes[offsets[i]:offsets[i + 1]].
+    """
+    buffers = [bytes(b) for b in buffers]
+    offsets = np.zeros(len(buffers) + 1, dtype=np.int64)
+    np.cumsum([len(b) // 2 for b in buffers], out=offsets[1:])
+    codes = np.frombuffer(b"".join(buffers), dtype='>u2')
+    return codes, offsets
+
+
+def decode_batch(buffers):
+    """Decode the moves of many games, as a list of lists of chess moves."""
+    if pgn.move_encoding() == pgn.COMPACT:
+        # Compact codes depend on the position and can not be looked up.
+        return [pgn.decode_moves(b) for b in buffers]
+    codes, offsets = code_arrays(buffers)
+    moves = move_array()[codes]
+    return [list(m) for m in np.split(moves, offsets[1:-1])]
+
+
+def encode_batch(games):
+    """Encode many games given as lists of chess moves, as a list of bytes.
+
+    The encoding is the same as `pgn.encode_move_list`.
+    """
+    if pgn.move_encoding() == pgn.COMPACT:
+        return [pgn.encode_move_list(game) for game in games]
+    moves = [move for game in games for move in game]
+    count = len(moves)
+    from_squares = np.fromiter((m.from_square for m in moves), np.uint16, count)
+    to_squares = np.fromiter((m.to_square for m in moves), np.uint16, count)
+    promotions = np.fromiter((m.promotion or 0 for m in moves), np.uint16, count)
+
+    promoted = promotions > 0
+    byte1 = np.where(promoted, from_squares + 64, from_squares)
+    byte2 = np.where(promoted, to_squares + 64 * (promotions - 2), to_squares)
+    data = ((byte1 << 8) | byte2).astype('>u2').tobytes()
+
+    res = []
+    start = 0
+    for game in games:
+        end = start + 2 * len(game)
+        res.append(data[start:end])
+        start = end
+    return res
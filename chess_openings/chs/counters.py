@@ -0,0 +1,65 @@
+from collections import defaultdict
+from django.db import connection
+
+
+# Index of each result in a (games, white, draws, black) counter.
+RESULT_INDEX = {'1-0': 1, '1/2-1/2': 2, '0-1': 3}
+
+# Adds the rows of `select`, key columns then counters, to the counters of
+# `table`, which are unique by key.
+UPSERT_SQL = """
+INSERT INTO {table} ({keys}, games, white, draws, black)
+{select}
+ON CONFLICT ({keys}) DO UPDATE SET
+    games = {table}.games + EXCLUDED.games,
+    white = {table}.white + EXCLUDED.white,
+    draws = {table}.draws + EXCLUDED.draws,
+    black = {table}.black + EXCLUDED.black
+"""
+
+# Counters of a group of games, with a `result` column.
+RESULT_COUNTS_SQL = """count(*),
+    count(*) FILTER (WHERE result = '1-0'),
+    count(*) FILTER (WHERE result = '1/2-1/2'),
+    count(*) FILTER (WHERE result = '0-1')"""
+
+UNNEST_SQL = """
+SELECT * FROM unnest({arrays}) AS r ({keys}, games, white, draws, black)
+ORDER BY {keys}
+"""
+
+
+def upsert_sql(table, keys, select):
+    return UPSERT_SQL.format(table=table, keys=", ".join(keys), select=select)
+
+
+def counts():
+    """Counters by key, filled with `count` and saved with `add`."""
+    return defaultdict(lambda: [0, 0, 0, 0])
+
+
+def count(counter, result, sign=1):
+    """Add (or remove, with sign=-1) a game with `result` to a counter."""
+    counter[0] += sign
+    if result in RESULT_INDEX:
+        counter[RESULT_INDEX[result]] += sign
+
+
+def add(table, keys, types, counts):
+    """Add counters to the ones of `table`.
+
+    `counts` maps tuples of the `keys` columns, of SQL `types`, to
+    counters.
+    """
+    # Rows are sent as one array per column, in a single statement. They
+    # are inserted sorted, which keeps a consistent lock order between
+    # concurrent updates.
+    rows = [key + tuple(counts[key]) for key in counts]
+    if not rows:
+        return
+    arrays = ", ".join(
+        "%s::{}[]".format(t) for t in tuple(types) + ('integer',) * 4)
+    select = UNNEST_SQL.format(arrays=arrays, keys=", ".join(keys))
+    with connection.cursor() as cursor:
+        cursor.execute(upsert_sql(table, keys, select),
+                       [list(column) for column in zip(*rows)])
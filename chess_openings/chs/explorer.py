@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.db.models import Case, Count, When, BinaryField
+from django.db.models.functions import Substr
+from . import counters
+from . import models
+from . import pgn
+import chess
+
+
+KEYS = ('prefix', 'move')
+
+# Counts every game of `table` (a table or query with `moves` and `result`
+# columns) in the statistics, set-based.
+RECORD_TABLE_SQL = """
+SELECT substring(moves FROM 1 FOR i * %(size)s),
+    substring(moves FROM i * %(size)s + 1 FOR %(size)s),
+    {counts}
+FROM {table} AS g, generate_series(0, %(depth)s - 1) AS i
+WHERE length(moves) > i * %(size)s
+GROUP BY 1, 2
+"""
+
+
+def depth():
+    """Number of plies for which statistics are precomputed."""
+    return getattr(settings, "CHS_EXPLORER_DEPTH", 20)
+
+
+def record_games(games, sign=1):
+    """Add (or remove, with sign=-1) games to the precomputed statistics.
+
+    `games` is a list of (moves, result) pairs.
+    """
+    size = pgn.move_size()
+    limit = depth() * size
+    counts = counters.counts()
+    for moves, result in games:
+        moves = bytes(moves)
+        for i in range(0, min(len(moves), limit), size):
+            key = (moves[:i], moves[i:i + size])
+            counters.count(counts[key], result, sign)
+    counters.add('chs_movestat', KEYS, ('bytea', 'bytea'), counts)
+
+
+def record_table(cursor, table):
+    """Add all games of a SQL table to the precomputed statistics."""
+    select = RECORD_TABLE_SQL.format(
+        table=table, counts=counters.RESULT_COUNTS_SQL)
+    cursor.execute(
+        counters.upsert_sql('chs_movestat', KEYS, select),
+        {'size': pgn.move_size(), 'depth': depth()}
+    )
+
+
+def continuations(moves):
+    """Statistics of the moves played after an encoded moves prefix.
+
+    Returns a list of (move, games, white, draws, black) tuples, most
+    played first.
+    """
+    size = pgn.move_size()
+    if len(moves) < depth() * size:
+        rows = models.MoveStat.objects.filter(
+                prefix=moves, games__gt=0
+            ).values_list('move', 'games', 'white', 'draws', 'black')
+    else:
+        # Deeper than the precomputed statistics, aggregate the games.
+        rows = models.Game.objects.filter(
+            moves__chs_startswith=moves
+        ).annotate(
+            next=Substr('moves', len(moves) + 1, size,
+                        output_field=BinaryField())
+        ).exclude(next=b"").values('next').annotate(
+            games=Count('pk'),
+            white=Count(Case(When(result='1-0', then=1))),
+            draws=Count(Case(When(result='1/2-1/2', then=1))),
+            black=Count(Case(When(result='0-1', then=1))),
+        ).values_list('next', 'games', 'white', 'draws', 'black')
+    return sorted(
+        ((bytes(r[0]),) + tuple(r[1:]) for r in rows),
+        key=lambda r: -r[1]
+    )
+
+
+def explore(uci_moves):
+    """Continuations of a position given by uci moves, for the explorer."""
+    moves = [chess.Move.from_uci(m) for m in uci_moves]
+    prefix = pgn.encode_move_list(moves)
+    board = chess.Board()
+    for move in moves:
+        if move not in board.legal_moves:
+            raise ValueError("illegal move {}".format(move.uci()))
+        board.push(move)
+
+    res = []
+    for code, games, white, draws, black in continuations(prefix):
+        move = pgn.decode_moves(prefix + code)[-1]
+        res.append({
+            'uci': move.uci(),
+            'san': board.san(move),
+            'games': games,
+            'white': white / games * 100,
+            'draws': draws / games * 100,
+            'black': black / games * 100,
+        })
+    return res
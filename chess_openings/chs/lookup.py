@@ -21,3 +21,30 @@ class ChessStartsOf(Lookup):
         params = rhs_params + lhs_params + lhs_params
         sql_code = "%s BETWEEN %s AND (%s::bytea || E'\\\\xff'::bytea)"
         return sql_code % (rhs, lhs, lhs), params
+
+
+class TrigramContains(Lookup):
+    """Case insensitive substring search, which pg_trgm indexes support."""
+    lookup_name = 'chs_icontains'
+
+    def process_rhs(self, compiler, connection):
+        rhs, params = super(TrigramContains, self).process_rhs(compiler, connection)
+        params = ["%%%s%%" % connection.ops.prep_for_like_query(p) for p in params]
+        return rhs, params
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        params = lhs_params + rhs_params
+        return "%s ILIKE %s" % (lhs, rhs), params
+
+
+class TrigramSimilar(Lookup):
+    """Fuzzy search, with the pg_trgm similarity operator."""
+    lookup_name = 'chs_similar'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        params = lhs_params + rhs_params
+        return "%s %%%% %s" % (lhs, rhs), params
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from chs import pgn
+import chess.pgn
+import time
+
+
+def read_full(file, limit):
+    """Read games with the default python-chess game builder."""
+    res = []
+    while len(res) < limit:
+        game = chess.pgn.read_game(file)
+        if not game:
+            break
+        res.append(pgn.encode_moves(game))
+    return res
+
+
+def read_lean(file, limit):
+    """Read games with the header and mainline only reader."""
+    res = []
+    while len(res) < limit:
+        record = pgn.read_record(file)
+        if not record:
+            break
+        res.append(record.moves)
+    return res
+
+
+class Command(BaseCommand):
+    help = "Compare the speed of the pgn readers on a file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--encoding', default="utf-8")
+        parser.add_argument('--games', type=int, default=10000,
+                            help="maximum number of games to read")
+
+    def handle(self, *args, **options):
+        results = []
+        for name, reader in (("full", read_full), ("lean", read_lean)):
+            with open(options['file'], encoding=options['encoding']) as f:
+                start = time.time()
+                moves = reader(f, options['games'])
+                elapsed = time.time() - start
+            rate = len(moves) / elapsed if elapsed > 0 else 0
+            self.stdout.write("{}: {} games in {:.2f}s ({:.1f} games/sec)".format(
+                name, len(moves), elapsed, rate))
+            results.append((moves, elapsed))
+
+        (full_moves, full_time), (lean_moves, lean_time) = results
+        if full_moves != lean_moves:
+            raise CommandError("readers disagree on the encoded moves")
+        if lean_time > 0:
+            self.stdout.write("speedup: {:.2f}x".format(full_time / lean_time))
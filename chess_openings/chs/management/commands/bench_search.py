@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from chs import models
+import time
+
+
+def searches(term):
+    """The name searches of the list views, as (label, queryset) pairs."""
+    return [
+        ("player name", models.Player.objects.filter(
+            Q(firstname__chs_icontains=term) | Q(lastname__chs_icontains=term))),
+        ("player fuzzy", models.Player.objects.filter(
+            Q(firstname__chs_similar=term) | Q(lastname__chs_similar=term))),
+        ("event name", models.Event.objects.filter(
+            event_name__chs_icontains=term)),
+        ("event location", models.Event.objects.filter(
+            location__chs_icontains=term)),
+        ("game location", models.Game.objects.filter(
+            location__chs_icontains=term)),
+    ]
+
+
+def timed_count(queryset, repeat, indexes):
+    """Average time of a count query in milliseconds, and its result."""
+    with transaction.atomic(), connection.cursor() as cursor:
+        if not indexes:
+            # Leaves sequential scans as the only plan.
+            cursor.execute("SET LOCAL enable_indexscan = off")
+            cursor.execute("SET LOCAL enable_bitmapscan = off")
+        start = time.time()
+        for i in range(repeat):
+            count = queryset.count()
+        return (time.time() - start) / repeat * 1000, count
+
+
+class Command(BaseCommand):
+    help = ("Time substring and fuzzy name searches with and without the "
+            "trigram indexes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='+')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("bench_search requires a PostgreSQL database")
+        for term in options['terms']:
+            for label, queryset in searches(term):
+                scan, count = timed_count(queryset, options['repeat'], False)
+                index, count = timed_count(queryset, options['repeat'], True)
+                self.stdout.write(
+                    "{} '{}': {} rows, sequential scan {:.2f} ms, "
+                    "index {:.2f} ms".format(label, term, count, scan, index))
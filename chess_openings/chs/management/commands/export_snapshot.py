@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Length
+from chs import models
+from chs import pgn
+from chs import snapshot
+import numpy as np
+import time
+
+
+# Snapshot columns copied from integer fields, see `snapshot.COLUMNS`.
+FIELDS = {
+    'ids': 'object_id',
+    'white': 'white_id',
+    'black': 'black_id',
+    'white_elo': 'white__elo_rating',
+    'black_elo': 'black__elo_rating',
+    'events': 'event_id',
+    'openings': 'opening_id',
+}
+
+
+def chunks(iterable, size):
+    """Split an iterable into lists of `size` items."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = ("Write a columnar snapshot of all games as .npy files, see "
+            "chs.snapshot to read it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # Both passes must see the same games.
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            count = self.write(options['directory'])
+        self.stdout.write("Wrote {} games in {:.1f}s".format(
+            count, time.time() - start))
+
+    def write(self, directory):
+        # The first pass sizes the arrays.
+        sizes = models.Game.objects.aggregate(
+            games=Count('pk'), moves=Sum(Length('moves')))
+        count = sizes['games']
+        arrays = snapshot.create(
+            directory, count, sizes['moves'] or 0, pgn.move_encoding())
+
+        games = models.Game.objects.order_by('object_id').values_list(
+            *(list(FIELDS.values()) + ['start_date', 'result', 'moves']))
+        unknown = snapshot.RESULT_CODES['*']
+        arrays['offsets'][0] = 0
+        position = 0
+        offset = 0
+        for rows in chunks(games.iterator(), 10000):
+            end = position + len(rows)
+            columns = list(zip(*rows))
+            for name, values in zip(FIELDS, columns):
+                arrays[name][position:end] = [
+                    -1 if v is None else v for v in values]
+            arrays['dates'][position:end] = [
+                'NaT' if d is None else d for d in columns[-3]]
+            arrays['results'][position:end] = [
+                snapshot.RESULT_CODES.get(r, unknown) for r in columns[-2]]
+
+            moves = b"".join(bytes(m) for m in columns[-1])
+            arrays['moves'][offset:offset + len(moves)] = np.frombuffer(
+                moves, np.uint8)
+            arrays['offsets'][position + 1:end + 1] = offset + np.cumsum(
+                [len(m) for m in columns[-1]])
+            offset += len(moves)
+            position = end
+
+        for array in arrays.values():
+            array.flush()
+        return count
@@ -0,0 +1,290 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from chs import explorer
+from chs import models
+from chs import pgn
+from chs import stats
+from io import StringIO
+import os
+import time
+
+
+# Staging tables only live until the end of the import transaction.
+CREATE_STAGING = """
+CREATE TEMPORARY TABLE import_game (
+    seq bigint PRIMARY KEY,
+    white_first varchar(50),
+    white_last varchar(50),
+    white_elo integer,
+    black_first varchar(50),
+    black_last varchar(50),
+    black_elo integer,
+    event_name varchar(60),
+    event_date date,
+    location varchar(60),
+    start_date date,
+    result varchar(7) NOT NULL,
+    moves bytea NOT NULL,
+    content_hash varchar(40) NOT NULL,
+    opening_id integer,
+    object_id integer
+) ON COMMIT DROP;
+
+CREATE TEMPORARY TABLE import_position (
+    seq bigint NOT NULL,
+    ply smallint NOT NULL,
+    zobrist bigint NOT NULL
+) ON COMMIT DROP;
+"""
+
+STAGING_COLUMNS = (
+    "seq", "white_first", "white_last", "white_elo",
+    "black_first", "black_last", "black_elo", "event_name", "event_date",
+    "location", "start_date", "result", "moves", "content_hash", "opening_id",
+)
+
+# Games already in the database, or repeated in the file, are skipped.
+REMOVE_DUPLICATES = """
+DELETE FROM import_game g
+WHERE EXISTS (SELECT 1 FROM chs_game WHERE content_hash = g.content_hash);
+
+DELETE FROM import_game g
+WHERE EXISTS (
+    SELECT 1 FROM import_game d
+    WHERE d.content_hash = g.content_hash AND d.seq < g.seq
+);
+"""
+
+# A player is identified by its name, the first game it appears in gives
+# its elo rating. Players with the same name already in the database are
+# reused, picking the oldest one.
+RESOLVE_PLAYERS = """
+CREATE TEMPORARY TABLE import_player ON COMMIT DROP AS
+SELECT DISTINCT ON (firstname, lastname)
+    firstname, lastname, elo, NULL::integer AS object_id, false AS new
+FROM (
+    SELECT seq, 0 AS side, white_first AS firstname, white_last AS lastname,
+        white_elo AS elo
+    FROM import_game WHERE white_last IS NOT NULL
+    UNION ALL
+    SELECT seq, 1, black_first, black_last, black_elo
+    FROM import_game WHERE black_last IS NOT NULL
+) AS sides
+ORDER BY firstname, lastname, seq, side;
+
+UPDATE import_player i SET object_id = p.object_id
+FROM (
+    SELECT p.firstname, p.lastname, min(p.object_id) AS object_id
+    FROM chs_player p
+    JOIN import_player USING (firstname, lastname)
+    GROUP BY p.firstname, p.lastname
+) AS p
+WHERE i.firstname = p.firstname AND i.lastname = p.lastname;
+
+UPDATE import_player SET object_id = nextval(%(sequence)s), new = true
+WHERE object_id IS NULL;
+
+INSERT INTO chs_object (id, owner_id, kind, version)
+SELECT object_id, %(owner)s, 'player', 0 FROM import_player WHERE new;
+
+INSERT INTO chs_player (object_id, firstname, lastname, elo_rating)
+SELECT object_id, firstname, lastname, elo FROM import_player WHERE new;
+"""
+
+RESOLVE_EVENTS = """
+CREATE TEMPORARY TABLE import_event ON COMMIT DROP AS
+SELECT DISTINCT ON (event_name)
+    event_name, event_date, NULL::integer AS object_id, false AS new
+FROM import_game WHERE event_name IS NOT NULL
+ORDER BY event_name, seq;
+
+UPDATE import_event i SET object_id = e.object_id
+FROM (
+    SELECT e.event_name, min(e.object_id) AS object_id
+    FROM chs_event e
+    JOIN import_event USING (event_name)
+    GROUP BY e.event_name
+) AS e
+WHERE i.event_name = e.event_name;
+
+UPDATE import_event SET object_id = nextval(%(sequence)s), new = true
+WHERE object_id IS NULL;
+
+INSERT INTO chs_object (id, owner_id, kind, version)
+SELECT object_id, %(owner)s, 'event', 0 FROM import_event WHERE new;
+
+INSERT INTO chs_event (object_id, event_name, start_date)
+SELECT object_id, event_name, event_date FROM import_event WHERE new;
+"""
+
+INSERT_GAMES = """
+UPDATE import_game SET object_id = nextval(%(sequence)s);
+
+INSERT INTO chs_object (id, owner_id, kind, version)
+SELECT object_id, %(owner)s, 'game', 0 FROM import_game ORDER BY seq;
+
+INSERT INTO chs_game (object_id, moves, white_id, black_id, start_date,
+                      location, event_id, result, content_hash, opening_id)
+SELECT g.object_id, g.moves, w.object_id, b.object_id, g.start_date,
+    g.location, e.object_id, g.result, g.content_hash, g.opening_id
+FROM import_game g
+LEFT JOIN import_player w
+    ON w.firstname = g.white_first AND w.lastname = g.white_last
+LEFT JOIN import_player b
+    ON b.firstname = g.black_first AND b.lastname = g.black_last
+LEFT JOIN import_event e ON e.event_name = g.event_name
+ORDER BY g.seq;
+
+INSERT INTO chs_position (zobrist, game_id, ply)
+SELECT p.zobrist, g.object_id, p.ply
+FROM import_position p
+JOIN import_game g USING (seq);
+"""
+
+
+# Invalidates the pages of the players, events and openings of the new games.
+BUMP_VERSIONS = """
+UPDATE chs_object SET version = version + 1
+WHERE id IN (
+    SELECT s.id FROM chs_game g
+    JOIN import_game USING (object_id)
+    CROSS JOIN LATERAL (VALUES (g.white_id), (g.black_id), (g.event_id))
+        AS s (id)
+    UNION
+    SELECT a.id::integer FROM chs_opening o
+    CROSS JOIN LATERAL unnest(string_to_array(o.path, '/')) AS a (id)
+    WHERE o.object_id IN (SELECT opening_id FROM import_game) AND a.id <> ''
+)
+"""
+
+# The games added by the current chunk.
+IMPORTED_GAMES = """(
+    SELECT * FROM chs_game
+    WHERE object_id IN (SELECT object_id FROM import_game)
+)"""
+
+
+def copy_value(value):
+    """Format a value for a COPY in text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bytes):
+        return "\\\\x" + value.hex()
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def staging_row(seq, record, openings):
+    white = record.white or (None, None, None)
+    black = record.black or (None, None, None)
+    event = record.event or (None, None)
+    values = (seq,) + white + black + event + (
+        record.location, record.date, record.result, record.moves,
+        record.hash, openings.classify(record.moves))
+    return "\t".join(copy_value(v) for v in values) + "\n"
+
+
+def position_rows(seq, record):
+    return "".join(
+        "{}\t{}\t{}\n".format(seq, ply, h)
+        for ply, h in enumerate(pgn.position_hashes(record.moves), 1)
+    )
+
+
+class Command(BaseCommand):
+    help = ("Import games from pgn files, using COPY and set-based SQL. "
+            "Interrupted imports resume where the last chunk ended.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+')
+        parser.add_argument('--owner', required=True,
+                            help="pseudo of the account owning the new objects")
+        parser.add_argument('--encoding', default="utf-8",
+                            help="encoding of the pgn files")
+        parser.add_argument('--processes', type=int, default=None,
+                            help="number of parsing processes")
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help="number of games imported per transaction")
+        parser.add_argument('--restart', action='store_true',
+                            help="ignore saved import positions")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("import_pgn requires a PostgreSQL database")
+        try:
+            owner = models.Account.objects.get(pseudo=options['owner'])
+        except models.Account.DoesNotExist:
+            raise CommandError("unknown account " + options['owner'])
+
+        for path in options['files']:
+            self.stdout.write("Loading file " + path)
+            start = time.time()
+            count = self.import_file(path, owner, options)
+            self.stdout.write(pgn.throughput(count, start))
+
+    def import_file(self, path, owner, options):
+        path = os.path.abspath(path)
+        chunk_size = options['chunk_size']
+        offset = 0 if options['restart'] else models.checkpoint_offset(path)
+        if offset:
+            self.stdout.write("Resuming at byte {}".format(offset))
+
+        if options['processes']:
+            chunks = pgn.read_chunks_parallel(
+                path, options['encoding'], options['processes'], chunk_size,
+                offset)
+            count = self.import_chunks(chunks, path, owner)
+        else:
+            with open(path, encoding=options['encoding']) as file:
+                file.seek(offset)
+                chunks = pgn.read_chunks(file, chunk_size)
+                count = self.import_chunks(chunks, path, owner)
+        models.clear_checkpoint(path)
+        return count
+
+    def import_chunks(self, chunks, path, owner):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_get_serial_sequence('chs_object', 'id')")
+            params = {'sequence': cursor.fetchone()[0], 'owner': owner.id}
+        openings = models.OpeningTrie.load()
+
+        count = 0
+        # The parallel reader closes database connections before starting
+        # its workers, so cursors are only opened once chunks are available.
+        for records, offset in chunks:
+            with transaction.atomic(), connection.cursor() as cursor:
+                self.import_records(cursor, records, params, openings)
+                models.save_checkpoint(path, offset)
+            count += len(records)
+            models.games_changed()
+        return count
+
+    def import_records(self, cursor, records, params, openings):
+        rows = StringIO()
+        positions = StringIO()
+        for seq, record in enumerate(records):
+            rows.write(staging_row(seq, record, openings))
+            positions.write(position_rows(seq, record))
+        rows.seek(0)
+        positions.seek(0)
+
+        cursor.execute(CREATE_STAGING)
+        cursor.copy_expert(
+            "COPY import_game ({}) FROM STDIN".format(
+                ", ".join(STAGING_COLUMNS)),
+            rows
+        )
+        cursor.copy_expert(
+            "COPY import_position (seq, ply, zobrist) FROM STDIN",
+            positions
+        )
+        cursor.execute("ANALYZE import_game")
+        cursor.execute(REMOVE_DUPLICATES)
+        cursor.execute(RESOLVE_PLAYERS, params)
+        cursor.execute(RESOLVE_EVENTS, params)
+        cursor.execute(INSERT_GAMES, params)
+        models.index_sides(cursor, IMPORTED_GAMES)
+        explorer.record_table(cursor, "import_game")
+        stats.record_table(cursor, IMPORTED_GAMES)
+        cursor.execute(BUMP_VERSIONS)
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chs import models
+from chs import pgn
+
+
+class Command(BaseCommand):
+    help = "Fill the position index for games which are not indexed yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--rebuild', action='store_true',
+                            help="reindex all games")
+
+    def handle(self, *args, **options):
+        last = 0
+        count = 0
+        while True:
+            games = list(
+                models.Game.objects.filter(object_id__gt=last)
+                .order_by('object_id')
+                .values_list('object_id', 'moves')[:options['batch_size']]
+            )
+            if not games:
+                break
+            last = games[-1][0]
+
+            with transaction.atomic():
+                ids = [pk for pk, moves in games]
+                positions = models.Position.objects.filter(game_id__in=ids)
+                if options['rebuild']:
+                    positions.delete()
+                    indexed = set()
+                else:
+                    indexed = set(positions.values_list('game_id', flat=True))
+                models.Position.objects.bulk_create(
+                    [
+                        models.Position(zobrist=h, game_id=pk, ply=ply)
+                        for pk, moves in games if pk not in indexed
+                        for ply, h in enumerate(pgn.position_hashes(moves), 1)
+                    ],
+                    batch_size=10000
+                )
+            count += len(games) - len(indexed)
+
+        self.stdout.write("Indexed {} games".format(count))
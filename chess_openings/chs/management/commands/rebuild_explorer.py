@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from chs import explorer
+
+
+class Command(BaseCommand):
+    help = "Recompute the opening explorer statistics from all games."
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("TRUNCATE chs_movestat")
+            explorer.record_table(cursor, "chs_game")
+            cursor.execute("SELECT count(*) FROM chs_movestat")
+            count = cursor.fetchone()[0]
+        self.stdout.write("Stored statistics for {} moves".format(count))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from chs import models
+
+
+class Command(BaseCommand):
+    help = "Recompute the game search table from all games and players."
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("TRUNCATE chs_gameside")
+            models.index_sides(cursor, "chs_game")
+            cursor.execute("SELECT count(*) FROM chs_gameside")
+            count = cursor.fetchone()[0]
+        self.stdout.write("Stored {} game sides".format(count))
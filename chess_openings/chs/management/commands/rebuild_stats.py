@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from chs import stats
+
+
+SAVE_CURRENT = """
+CREATE TEMPORARY TABLE current_stats ON COMMIT DROP AS
+SELECT object_id, color, games, white, draws, black FROM chs_resultstat
+"""
+
+# Counters which differ between the saved and the recomputed rows. Counters
+# of objects whose games were all removed are kept at zero, and are the same
+# as a missing row.
+COUNT_DIFFERENCES = """
+SELECT count(*) FROM current_stats c
+FULL JOIN chs_resultstat r USING (object_id, color)
+WHERE (coalesce(c.games, 0), coalesce(c.white, 0), coalesce(c.draws, 0),
+       coalesce(c.black, 0))
+    <> (coalesce(r.games, 0), coalesce(r.white, 0), coalesce(r.draws, 0),
+        coalesce(r.black, 0))
+"""
+
+
+class Command(BaseCommand):
+    help = "Recompute the player, event and opening result counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="only report counters which differ from "
+                                 "the recomputed ones")
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(SAVE_CURRENT)
+            cursor.execute("TRUNCATE chs_resultstat")
+            stats.record_table(cursor, "chs_game")
+            cursor.execute(COUNT_DIFFERENCES)
+            count = cursor.fetchone()[0]
+            if options['check']:
+                transaction.set_rollback(True)
+
+        if options['check']:
+            self.stdout.write("{} counters differ".format(count))
+        else:
+            self.stdout.write("Rebuilt counters, {} had changed".format(count))
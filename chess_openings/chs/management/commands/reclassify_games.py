@@ -0,0 +1,74 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from chs import models
+from chs import stats
+
+
+class Command(BaseCommand):
+    help = ("Recompute the opening tree, and the opening of every game with "
+            "a merge of the games and openings sorted by moves.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        models.bump_versions(models.rebuild_opening_tree())
+        openings = [
+            (bytes(moves), pk) for moves, pk in
+            models.Opening.objects.order_by('moves')
+            .values_list('moves', 'object_id')
+        ]
+        next_opening = 0
+        # Openings which are a prefix of the current game, shortest first.
+        stack = []
+
+        last = None
+        count = 0
+        while True:
+            games = models.Game.objects.order_by('moves', 'object_id')
+            if last is not None:
+                games = games.filter(
+                    Q(moves__gt=last[0]) | Q(moves=last[0], object_id__gt=last[1])
+                )
+            games = list(games.values_list('moves', 'object_id', 'opening_id')
+                         [:options['batch_size']])
+            if not games:
+                break
+            last = games[-1][:2]
+
+            changed = defaultdict(list)
+            for moves, pk, current in games:
+                moves = bytes(moves)
+                # A prefix sorts before the sequences starting with it.
+                while (next_opening < len(openings)
+                       and openings[next_opening][0] <= moves):
+                    opening = openings[next_opening]
+                    while stack and not opening[0].startswith(stack[-1][0]):
+                        stack.pop()
+                    stack.append(opening)
+                    next_opening += 1
+                while stack and not moves.startswith(stack[-1][0]):
+                    stack.pop()
+
+                opening = stack[-1][1] if stack else None
+                if opening != current:
+                    changed[opening].append(pk)
+
+            reclassified = models.Game.objects.filter(object_id__in=[
+                pk for ids in changed.values() for pk in ids])
+            # Pages showing the games, with their old and new openings.
+            stale = models.related_ids(reclassified)
+            with transaction.atomic():
+                for opening, ids in changed.items():
+                    models.Game.objects.filter(
+                        object_id__in=ids
+                    ).update(opening_id=opening)
+                models.bump_versions(
+                    stale | models.related_ids(reclassified))
+            count += sum(len(ids) for ids in changed.values())
+
+        stats.refresh_openings([pk for moves, pk in openings])
+        models.games_changed()
+        self.stdout.write("Reclassified {} games".format(count))
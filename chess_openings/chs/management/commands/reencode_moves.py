@@ -0,0 +1,131 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from chs import explorer
+from chs import models
+from chs import pgn
+import time
+
+
+SIZE_SQL = """
+SELECT pg_total_relation_size('chs_game'),
+    (SELECT sum(pg_relation_size(indexrelid)) FROM pg_index i
+     JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+     WHERE i.indrelid = 'chs_game'::regclass AND a.attname = 'moves')
+"""
+
+
+def sizes():
+    """Size of the game table and of its moves index, in bytes."""
+    with connection.cursor() as cursor:
+        cursor.execute(SIZE_SQL)
+        return cursor.fetchone()
+
+
+def prefix_latency(prefixes):
+    """Average time of a `chs_startswith` count query, in milliseconds."""
+    if not prefixes:
+        return 0
+    start = time.time()
+    for prefix in prefixes:
+        models.Game.objects.filter(moves__chs_startswith=prefix).count()
+    return (time.time() - start) / len(prefixes) * 1000
+
+
+def reencode(model, source, target, batch_size, hash_games=False):
+    """Convert the moves of all rows of `model` between two encodings."""
+    last = 0
+    count = 0
+    while True:
+        rows = model.objects.filter(object_id__gt=last).order_by('object_id')
+        if hash_games:
+            rows = rows.select_related('white', 'black', 'event')
+        rows = list(rows[:batch_size])
+        if not rows:
+            return count
+
+        with transaction.atomic():
+            for row in rows:
+                moves = pgn.decode_moves(row.moves, source)
+                row.moves = pgn.encode_move_list(moves, target)
+                fields = ['moves']
+                if hash_games and row.content_hash:
+                    row.content_hash = game_hash(row)
+                    fields.append('content_hash')
+                row.save(update_fields=fields)
+        last = rows[-1].object_id
+        count += len(rows)
+
+
+def game_hash(game):
+    """Recompute the content hash of a game, see `pgn.game_hash`."""
+    white = (game.white.firstname, game.white.lastname) if game.white else None
+    black = (game.black.firstname, game.black.lastname) if game.black else None
+    event = (game.event.event_name,) if game.event else None
+    date = str(game.start_date) if game.start_date else None
+    return pgn.game_hash(white, black, event, date, game.result, game.moves)
+
+
+class Command(BaseCommand):
+    help = ("Convert stored game and opening moves to another encoding, and "
+            "report table size, index size and prefix query latency.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='source', required=True,
+                            choices=[pgn.WIDE, pgn.COMPACT])
+        parser.add_argument('--to', dest='target', required=True,
+                            choices=[pgn.WIDE, pgn.COMPACT])
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--vacuum', action='store_true',
+                            help="rewrite the tables afterwards, so that "
+                                 "reported sizes reflect the new encoding")
+
+    def handle(self, *args, **options):
+        source, target = options['source'], options['target']
+        if source == target:
+            raise CommandError("source and target encodings are the same")
+        if pgn.move_encoding() != target:
+            raise CommandError(
+                "set CHS_MOVE_ENCODING to '{}' first".format(target))
+
+        openings = list(models.Opening.objects.values_list('moves', flat=True))
+        prefixes = [bytes(m) for m in openings[:50]]
+
+        table_size, index_size = sizes()
+        latency = prefix_latency(prefixes)
+        self.report("before", table_size, index_size, latency)
+
+        count = reencode(models.Opening, source, target, options['batch_size'])
+        self.stdout.write("Converted {} openings".format(count))
+        count = reencode(models.Game, source, target, options['batch_size'],
+                         hash_games=True)
+        self.stdout.write("Converted {} games".format(count))
+
+        # Explorer statistics are keyed by encoded moves.
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("TRUNCATE chs_movestat")
+            explorer.record_table(cursor, "chs_game")
+        self.stdout.write("Rebuilt the explorer statistics")
+
+        if options['vacuum']:
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM FULL ANALYZE chs_game")
+                cursor.execute("VACUUM FULL ANALYZE chs_opening")
+
+        prefixes = [
+            pgn.encode_move_list(pgn.decode_moves(p, source), target)
+            for p in prefixes
+        ]
+        table_size, index_size = sizes()
+        latency = prefix_latency(prefixes)
+        self.report("after", table_size, index_size, latency)
+
+    def report(self, label, table_size, index_size, latency):
+        self.stdout.write(
+            "{}: table {:.1f} MB, moves index {:.1f} MB, "
+            "prefix query {:.2f} ms".format(
+                label,
+                (table_size or 0) / 2**20,
+                (index_size or 0) / 2**20,
+                latency
+            )
+        )
@@ -0,0 +1,212 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from django.template.backends.django import DjangoTemplates
+import heapq
+import random
+import threading
+import time
+
+
+# Upper bounds of the histogram buckets.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Metrics are kept in memory, so each process serves its own.
+_lock = threading.Lock()
+_views = {}
+# Statistics of the request handled by the current thread.
+_local = threading.local()
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(upper bound, count) pairs, the last bound is "+Inf"."""
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+
+class ViewMetrics(object):
+    """Metrics of the requests to one url name."""
+
+    def __init__(self):
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.sql_time = 0
+        self.template_time = 0
+
+
+class RequestStats(object):
+    """SQL and template time of a request.
+
+    `sampled` is unset when its SQL queries were not captured, see
+    `capture_queries`.
+    """
+
+    def __init__(self, keep=5):
+        self.sampled = True
+        self.queries = 0
+        self.sql_time = 0
+        self.template_time = 0
+        # (time, sql) of the `keep` slowest statements, as a heap.
+        self.keep = keep
+        self.statements = []
+
+    def add_query(self, sql, duration):
+        self.queries += 1
+        self.sql_time += duration
+        if len(self.statements) < self.keep:
+            heapq.heappush(self.statements, (duration, sql))
+        else:
+            heapq.heappushpop(self.statements, (duration, sql))
+
+    def execute(self, execute, sql, params, many, context):
+        """Connection execute wrapper timing statements."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add_query(sql, time.perf_counter() - start)
+
+    def slowest(self):
+        return sorted(self.statements, reverse=True)
+
+
+def start_request(keep=5):
+    _local.stats = RequestStats(keep)
+    return _local.stats
+
+
+def end_request():
+    _local.stats = None
+
+
+@contextmanager
+def capture_queries(connection, stats, sample_rate=1):
+    """Add the queries run on `connection` to `stats`.
+
+    Statements go through an execute wrapper where Django has them (2.0 and
+    later). They are read back from the debug query log otherwise, which
+    formats every statement, so only a `sample_rate` fraction of the
+    requests is captured.
+    """
+    if hasattr(connection, 'execute_wrapper'):
+        with connection.execute_wrapper(stats.execute):
+            yield
+        return
+    if random.random() >= sample_rate:
+        stats.sampled = False
+        yield
+        return
+
+    debug = connection.force_debug_cursor
+    connection.force_debug_cursor = True
+    start = len(connection.queries_log)
+    try:
+        yield
+    finally:
+        connection.force_debug_cursor = debug
+        for query in list(connection.queries_log)[start:]:
+            stats.add_query(query['sql'], float(query['time']))
+
+
+class TimedTemplate(object):
+    """A template adding its render time to the current request."""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        stats = getattr(_local, 'stats', None)
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            if stats is not None:
+                stats.template_time += time.perf_counter() - start
+
+
+class TimedTemplates(DjangoTemplates):
+    """Django templates backend timing renders, see `TimedTemplate`.
+
+    Only templates loaded through the backend are timed, so included
+    templates count in the time of the template including them.
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(
+            super(TimedTemplates, self).from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(
+            super(TimedTemplates, self).get_template(template_name))
+
+
+def record(view, duration, stats):
+    with _lock:
+        metrics = _views.get(view)
+        if metrics is None:
+            metrics = _views[view] = ViewMetrics()
+        metrics.duration.observe(duration)
+        metrics.template_time += stats.template_time
+        if stats.sampled:
+            metrics.queries.observe(stats.queries)
+            metrics.sql_time += stats.sql_time
+
+
+def label(value):
+    return '"{}"'.format(str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+
+
+def render():
+    """All metrics, in the Prometheus text format."""
+    with _lock:
+        views = sorted(_views.items())
+        lines = []
+
+        def histogram(name, help, attr):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} histogram".format(name))
+            for view, metrics in views:
+                values = getattr(metrics, attr)
+                for bound, count in values.cumulative():
+                    lines.append("{}_bucket{{view={},le={}}} {}".format(
+                        name, label(view), label(bound), count))
+                lines.append("{}_sum{{view={}}} {}".format(
+                    name, label(view), values.sum))
+                lines.append("{}_count{{view={}}} {}".format(
+                    name, label(view), sum(values.counts)))
+
+        def counter(name, help, attr):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} counter".format(name))
+            for view, metrics in views:
+                lines.append("{}{{view={}}} {}".format(
+                    name, label(view), getattr(metrics, attr)))
+
+        histogram("chs_request_duration_seconds",
+                  "Request latency by url name.", 'duration')
+        histogram("chs_request_queries",
+                  "SQL queries per sampled request by url name.", 'queries')
+        counter("chs_request_sql_seconds_total",
+                "Time spent running SQL queries in sampled requests by url "
+                "name.", 'sql_time')
+        counter("chs_request_template_seconds_total",
+                "Time spent rendering templates by url name.", 'template_time')
+    return "\n".join(lines) + "\n"
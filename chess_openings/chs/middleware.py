@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.db import connection
+from . import metrics
+from . import models
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class AccountMiddleware(object):
+    """Load the logged in account once per request, as `request.account`.
+
+    It is None for anonymous requests, which run no query.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.account = models.session_account(request.session)
+        return self.get_response(request)
+
+
+class MetricsMiddleware(object):
+    """Record the latency, SQL queries and template render time of requests
+    by url name, see `chs.metrics`.
+
+    Requests going over the CHS_SLOW_REQUEST_SECONDS or
+    CHS_SLOW_REQUEST_QUERIES settings are logged with their slowest
+    statements. Before Django 2.0, SQL queries are only captured for the
+    CHS_METRICS_SQL_SAMPLE_RATE fraction of the requests. The content of
+    streaming responses is produced after the middleware returns, and is
+    not measured.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = metrics.start_request(
+            getattr(settings, 'CHS_SLOW_REQUEST_STATEMENTS', 5))
+        sample_rate = getattr(settings, 'CHS_METRICS_SQL_SAMPLE_RATE', 1)
+        start = time.perf_counter()
+        try:
+            with metrics.capture_queries(connection, stats, sample_rate):
+                response = self.get_response(request)
+        finally:
+            metrics.end_request()
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else "unmatched"
+        metrics.record(view, duration, stats)
+        if self.is_slow(duration, stats):
+            self.log_slow(request, view, duration, stats)
+        return response
+
+    def is_slow(self, duration, stats):
+        seconds = getattr(settings, 'CHS_SLOW_REQUEST_SECONDS', None)
+        queries = getattr(settings, 'CHS_SLOW_REQUEST_QUERIES', None)
+        return ((seconds is not None and duration > seconds)
+                or (queries is not None and stats.queries > queries))
+
+    def log_slow(self, request, view, duration, stats):
+        if stats.sampled:
+            queries = "%d queries in %.3fs" % (stats.queries, stats.sql_time)
+        else:
+            queries = "queries not sampled"
+        logger.warning(
+            "Slow request %s %s (%s): %.3fs, %s, templates in %.3fs%s",
+            request.method, request.get_full_path(), view, duration,
+            queries, stats.template_time,
+            "".join("\n  %.3fs %s" % statement
+                    for statement in stats.slowest())
+        )
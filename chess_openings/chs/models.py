@@ -1,11 +1,20 @@
-from django.db import models
-from django.db.models import Q
+import chess
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.core.cache import caches
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Length
+from collections import OrderedDict, defaultdict
+import os
+import uuid
 from . import pgn
 from . import lookup
 
 
 models.BinaryField.register_lookup(lookup.ChessStartsWith)
 models.BinaryField.register_lookup(lookup.ChessStartsOf)
+models.CharField.register_lookup(lookup.TrigramContains)
+models.CharField.register_lookup(lookup.TrigramSimilar)
 
 
 class Account(models.Model):
@@ -19,34 +28,105 @@ class Account(models.Model):
     def __str__(self):
         return self.pseudo
 
+    def editable_ids(self):
+        """Ids of the objects the account was granted edit rights on."""
+        if not hasattr(self, 'editable'):
+            self.editable = list(self.can_edit.values_list('id', flat=True))
+        return set(pk for pk in self.editable if pk is not None)
+
     def has_edit_rights(self, obj):
-        id = obj.object_id
-        obj = Object.objects.get(pk=id)
-        return self.admin or obj.owner == self or self.can_edit.filter(id=id).exists()
+        """Whether the account can edit a game, player, event or opening.
+
+        The object row of `obj` should be selected with it, the check then
+        runs no query once `editable_ids` is loaded.
+        """
+        return (self.admin or obj.object.owner_id == self.id
+                or obj.object_id in self.editable_ids())
+
 
+def session_account(session):
+    """The account logged in a session, or None.
 
-def has_edit_rights(account_pk, obj):
-    return Account.objects.get(pk=account_pk).has_edit_rights(obj)
+    The ids of the objects it can edit are loaded with it, in one query.
+    """
+    if not session.get('account'):
+        return None
+    return Account.objects.filter(
+            pk=session['account']
+        ).annotate(editable=ArrayAgg('can_edit')).first()
 
 
 class Object(models.Model):
     """An object to be displayed in the website."""
+    GAME = 'game'
+    PLAYER = 'player'
+    EVENT = 'event'
+    OPENING = 'opening'
+    KINDS = (
+        (GAME, "game"),
+        (PLAYER, "player"),
+        (EVENT, "event"),
+        (OPENING, "opening"),
+    )
+
     owner = models.ForeignKey(Account, models.CASCADE)
+    # Model of the game, player, event or opening using this object.
+    kind = models.CharField(max_length=7, choices=KINDS, default="",
+                            db_index=True)
+    # Incremented when the page of the object changes, see `bump_versions`.
+    version = models.PositiveIntegerField(default=0)
 
     def comments(self):
-        return Comment.objects.filter(object=self).order_by('time')
+        return Comment.objects.filter(
+                object=self
+            ).select_related('account').order_by('time')
+
+    class Meta:
+        # Objects of an account, by kind.
+        indexes = [models.Index(fields=['owner', 'kind'])]
 
     def delete(self):
         self.account_set.clear()
         return super(Object, self).delete()
 
 
-def create_obj(account):
-    obj = Object(owner=account)
+def bump_versions(ids):
+    """Invalidate the cached pages of objects.
+
+    `ids` is a list of object ids, or a queryset of them.
+    """
+    Object.objects.filter(id__in=ids).update(version=F('version') + 1)
+
+
+def related_ids(games):
+    """Objects whose page shows one of `games` (a Game queryset).
+
+    These are the games, their players and events, and their openings with
+    the ancestors of the openings.
+    """
+    ids = set()
+    rows = games.values_list(
+        'object_id', 'white_id', 'black_id', 'event_id', 'opening__path')
+    for game, white, black, event, path in rows:
+        ids.update((game, white, black, event))
+        ids.update(int(pk) for pk in (path or "").split("/") if pk)
+    ids.discard(None)
+    return ids
+
+
+def create_obj(account, kind):
+    obj = Object(owner=account, kind=kind)
     obj.save()
     return obj
 
 
+def create_objs(account, count, kind):
+    """Create `count` objects with a single bulk insert."""
+    return Object.objects.bulk_create(
+        [Object(owner=account, kind=kind) for _ in range(count)]
+    )
+
+
 class Comment(models.Model):
     """A comment on an object."""
     account = models.ForeignKey(Account, models.CASCADE)
@@ -63,6 +143,10 @@ class Player(models.Model):
     elo_rating = models.IntegerField(null=True, db_index=True)
     nationality = models.CharField(max_length=3, null=True, db_index=True)
 
+    class Meta:
+        # Keyset pagination of player lists.
+        indexes = [models.Index(fields=['lastname', 'object'])]
+
     def __str__(self):
         elo_str = " ({})".format(self.elo_rating) if self.elo_rating else ""
         return "{} {}{}".format(self.firstname, self.lastname, elo_str)
@@ -89,8 +173,7 @@ def find_or_add_player(firstname, lastname, owner, **kwargs):
     if res.exists():
         return res.first()
     else:
-        obj = Object(owner=owner)
-        obj.save()
+        obj = create_obj(owner, Object.PLAYER)
         player = Player(
             object=obj,
             firstname=firstname,
@@ -101,6 +184,45 @@ def find_or_add_player(firstname, lastname, owner, **kwargs):
         return player
 
 
+def find_or_add_players(players, owner, cache=None):
+    """Bulk version of `find_or_add_player`.
+
+    `players` is a list of (firstname, lastname, elo) tuples. Returns a dict
+    mapping (firstname, lastname) to the player primary key.
+    """
+    if cache is None:
+        cache = ImportCache(0)
+    res = {}
+    for firstname, lastname, elo in players:
+        pk = cache.players.get((firstname, lastname))
+        if pk is not None:
+            res[(firstname, lastname)] = pk
+
+    missing = set(p[:2] for p in players) - set(res)
+    if missing and not cache.players.complete:
+        found = Player.objects.filter(
+                lastname__in=set(name[1] for name in missing)
+            ).order_by('object_id').values_list('firstname', 'lastname', 'object_id')
+        for firstname, lastname, pk in found:
+            if (firstname, lastname) in missing:
+                res.setdefault((firstname, lastname), pk)
+                cache.players.put((firstname, lastname), pk)
+
+    new = OrderedDict()
+    for firstname, lastname, elo in players:
+        if (firstname, lastname) not in res:
+            new.setdefault((firstname, lastname), elo)
+    objs = create_objs(owner, len(new), Object.PLAYER)
+    Player.objects.bulk_create([
+        Player(object=obj, firstname=name[0], lastname=name[1], elo_rating=elo)
+        for obj, (name, elo) in zip(objs, new.items())
+    ])
+    for obj, name in zip(objs, new):
+        res[name] = obj.id
+        cache.players.put(name, obj.id)
+    return res
+
+
 class Event(models.Model):
     """A chess event record."""
     object = models.OneToOneField(Object, models.PROTECT, primary_key=True)
@@ -109,6 +231,10 @@ class Event(models.Model):
     start_date = models.DateField(null=True, db_index=True)
     end_date = models.DateField(null=True, db_index=True)
 
+    class Meta:
+        # Keyset pagination of event lists.
+        indexes = [models.Index(fields=['start_date', 'object'])]
+
     def __str__(self):
         location_str = ", " + self.location if self.location else ""
         start_date_str = ", " + str(self.start_date) if self.start_date else ""
@@ -132,8 +258,7 @@ def find_or_add_event(name, owner, **kwargs):
     if res.exists():
         return res.first()
     else:
-        obj = Object(owner=owner)
-        obj.save()
+        obj = create_obj(owner, Object.EVENT)
         event = Event(
             object=obj,
             event_name=name,
@@ -143,6 +268,110 @@ def find_or_add_event(name, owner, **kwargs):
         return event
 
 
+def find_or_add_events(events, owner, cache=None):
+    """Bulk version of `find_or_add_event`.
+
+    `events` is a list of (name, start_date) tuples. Returns a dict mapping
+    event names to the event primary key.
+    """
+    if cache is None:
+        cache = ImportCache(0)
+    res = {}
+    for name, start_date in events:
+        pk = cache.events.get(name)
+        if pk is not None:
+            res[name] = pk
+
+    missing = set(e[0] for e in events) - set(res)
+    if missing and not cache.events.complete:
+        found = Event.objects.filter(
+                event_name__in=missing
+            ).order_by('object_id').values_list('event_name', 'object_id')
+        for name, pk in found:
+            res.setdefault(name, pk)
+            cache.events.put(name, pk)
+
+    new = OrderedDict()
+    for name, start_date in events:
+        if name not in res:
+            new.setdefault(name, start_date)
+    objs = create_objs(owner, len(new), Object.EVENT)
+    Event.objects.bulk_create([
+        Event(object=obj, event_name=name, start_date=start_date)
+        for obj, (name, start_date) in zip(objs, new.items())
+    ])
+    for obj, name in zip(objs, new):
+        res[name] = obj.id
+        cache.events.put(name, obj.id)
+    return res
+
+
+class LookupCache(object):
+    """A bounded LRU mapping from names to primary keys."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        # Set when every row of the table is known to be in the cache,
+        # in which case names not found do not exist in the database.
+        self.complete = False
+
+    def get(self, key):
+        pk = self.data.get(key)
+        if pk is not None:
+            self.data.move_to_end(key)
+        return pk
+
+    def put(self, key, pk):
+        self.data[key] = pk
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.complete = False
+
+    def fill(self, rows):
+        """Fill the cache from (key, pk) rows ordered by primary key."""
+        count = 0
+        for key, pk in rows:
+            count += 1
+            if count > self.maxsize:
+                return
+            if key not in self.data:
+                self.data[key] = pk
+        self.complete = True
+
+
+class ImportCache(object):
+    """Player and event lookup cache for the duration of an import.
+
+    Players are keyed on (firstname, lastname) and events on their name.
+    Openings are loaded in a trie to classify the imported games.
+    """
+
+    def __init__(self, maxsize=500000):
+        self.players = LookupCache(maxsize)
+        self.events = LookupCache(maxsize)
+        self.openings = None
+
+    def opening_trie(self):
+        """The openings, loaded on first use."""
+        if self.openings is None:
+            self.openings = OpeningTrie.load()
+        return self.openings
+
+    def warm(self):
+        """Load known players and events, with one query per table."""
+        limit = self.players.maxsize + 1
+        players = Player.objects.order_by('object_id').values_list(
+            'firstname', 'lastname', 'object_id')[:limit]
+        self.players.fill(((f, l), pk) for f, l, pk in players)
+
+        limit = self.events.maxsize + 1
+        events = Event.objects.order_by('object_id').values_list(
+            'event_name', 'object_id')[:limit]
+        self.events.fill(events)
+
+
 class Game(models.Model):
     """A chess game record."""
     object = models.OneToOneField(Object, models.PROTECT, primary_key=True)
@@ -163,6 +392,19 @@ class Game(models.Model):
     location = models.CharField(max_length=60, null=True, db_index=True)
     event = models.ForeignKey(Event, models.SET_NULL, null=True)
     result = models.CharField(max_length=7, db_index=True)
+    # Set for imported games, see `pgn.game_hash`.
+    content_hash = models.CharField(max_length=40, null=True, unique=True)
+    # Deepest opening the game starts with.
+    opening = models.ForeignKey(
+        'Opening',
+        models.SET_NULL,
+        related_name="classified_games",
+        null=True,
+    )
+
+    class Meta:
+        # Keyset pagination of game lists.
+        indexes = [models.Index(fields=['start_date', 'object'])]
 
     def __str__(self):
         white_name = str(self.white) if self.white else "unknown"
@@ -177,43 +419,414 @@ class Game(models.Model):
         return players + result_str + context
 
     def moves_san(self):
-        binary_moves = [ord(x) for x in self.moves]
-        return pgn.san_moves(pgn.decode_moves(binary_moves))
+        return pgn.replay_moves(bytes(self.moves))[0]
+
+    def moves_fen(self):
+        return pgn.replay_moves(bytes(self.moves))[1]
 
     def openings(self):
-        return Opening.objects.filter(moves__chs_startof=self.moves)
+        if self.opening_id is None:
+            return Opening.objects.none()
+        return Opening.objects.filter(
+                pk__in=self.opening.ancestor_ids()
+            ).order_by('path')
 
     def delete(self):
         obj = self.object
         return super(Game, self).delete() + obj.delete()
 
 
+GAMES_GENERATION_KEY = "chs:games_generation"
+
+
+def games_generation():
+    """A token changed whenever games are added, removed or reclassified,
+    or their players or events are edited.
+
+    It is part of the cache keys of game statistics, so that changes
+    invalidate them. It is kept in the 'shared' cache, so that a change
+    made by a process invalidates the statistics cached by the others.
+    """
+    return caches['shared'].get_or_set(
+        GAMES_GENERATION_KEY, new_generation, None)
+
+
+def new_generation():
+    # A random token rather than an incremented counter, incr is not atomic
+    # with the database cache.
+    return uuid.uuid4().hex
+
+
+def games_changed():
+    """Change the games generation, once the current transaction commits.
+
+    Statistics computed before the commit would otherwise be cached under
+    the new generation.
+    """
+    transaction.on_commit(lambda: caches['shared'].set(
+        GAMES_GENERATION_KEY, new_generation(), None))
+
+
+class Position(models.Model):
+    """A position reached in a game, identified by its zobrist hash."""
+    zobrist = models.BigIntegerField()
+    game = models.ForeignKey(Game, models.CASCADE)
+    ply = models.SmallIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['zobrist', 'game'])]
+
+
+def index_positions(game):
+    """Rebuild the position index of a game."""
+    Position.objects.filter(game=game).delete()
+    Position.objects.bulk_create([
+        Position(zobrist=h, game=game, ply=ply)
+        for ply, h in enumerate(pgn.position_hashes(game.moves), 1)
+    ])
+
+
+def games_reaching(board):
+    """Games going through a position, whatever the move order."""
+    zobrist = pgn.position_hash(board)
+    if zobrist == pgn.position_hash(chess.Board()):
+        return Game.objects.all()
+    positions = Position.objects.filter(zobrist=zobrist)
+    return Game.objects.filter(object_id__in=positions.values('game_id'))
+
+
+class GameSide(models.Model):
+    """A player of a game, copied from the game and player records.
+
+    There is one row per side with a known player, so that games can be
+    searched by player with a single indexed table.
+    """
+    game = models.ForeignKey(Game, models.CASCADE, related_name="sides")
+    white = models.BooleanField()
+    player = models.ForeignKey(Player, models.CASCADE, related_name="sides")
+    firstname = models.CharField(max_length=50, blank=True)
+    lastname = models.CharField(max_length=50, blank=True)
+    elo_rating = models.IntegerField(null=True)
+    nationality = models.CharField(max_length=3, null=True)
+    result = models.CharField(max_length=7)
+    start_date = models.DateField(null=True)
+    event = models.ForeignKey(Event, models.SET_NULL, null=True)
+
+    class Meta:
+        unique_together = ('game', 'white')
+        indexes = [
+            models.Index(fields=['player', 'start_date']),
+            models.Index(fields=['nationality', 'start_date']),
+            models.Index(fields=['elo_rating', 'start_date']),
+        ]
+
+
+# Adds the sides of the games of `games` (a table or query with the columns
+# of chs_game), set-based.
+INSERT_SIDES_SQL = """
+INSERT INTO chs_gameside (game_id, white, player_id, firstname, lastname,
+                          elo_rating, nationality, result, start_date,
+                          event_id)
+SELECT g.object_id, s.white, p.object_id, p.firstname, p.lastname,
+    p.elo_rating, p.nationality, g.result, g.start_date, g.event_id
+FROM {games} AS g
+CROSS JOIN (VALUES (true), (false)) AS s (white)
+JOIN chs_player p
+    ON p.object_id = CASE WHEN s.white THEN g.white_id ELSE g.black_id END
+"""
+
+
+def index_sides(cursor, games, params=None):
+    """Add the sides of the games of a SQL table or subquery."""
+    cursor.execute(INSERT_SIDES_SQL.format(games=games), params)
+
+
+def game_sides(game):
+    """Side rows of a game."""
+    return [
+        GameSide(
+            game_id=game.object_id,
+            white=white,
+            player_id=player.object_id,
+            firstname=player.firstname,
+            lastname=player.lastname,
+            elo_rating=player.elo_rating,
+            nationality=player.nationality,
+            result=game.result,
+            start_date=game.start_date,
+            event_id=game.event_id,
+        )
+        for white, player in ((True, game.white), (False, game.black))
+        if player is not None
+    ]
+
+
+def refresh_game_sides(game):
+    """Rebuild the side rows of a new or modified game."""
+    GameSide.objects.filter(game=game).delete()
+    GameSide.objects.bulk_create(game_sides(game))
+
+
+def refresh_player_sides(player):
+    """Copy the modified fields of a player to its side rows."""
+    GameSide.objects.filter(player=player).update(
+        firstname=player.firstname,
+        lastname=player.lastname,
+        elo_rating=player.elo_rating,
+        nationality=player.nationality,
+    )
+
+
+class MoveStat(models.Model):
+    """Results of the games playing `move` after the moves `prefix`.
+
+    Filled up to CHS_EXPLORER_DEPTH plies, see `explorer.record_games`.
+    """
+    prefix = models.BinaryField()
+    move = models.BinaryField()
+    games = models.IntegerField(default=0)
+    white = models.IntegerField(default=0)
+    draws = models.IntegerField(default=0)
+    black = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('prefix', 'move')
+
+
+class ResultStat(models.Model):
+    """Result counters of the games of a player, event or opening.
+
+    Players have one row per color ('w' or 'b'), events and openings one row
+    with an empty color. Openings only count the games classified under
+    them, not under their variations.
+    """
+    object = models.ForeignKey(Object, models.CASCADE)
+    color = models.CharField(max_length=1, blank=True)
+    games = models.IntegerField(default=0)
+    white = models.IntegerField(default=0)
+    draws = models.IntegerField(default=0)
+    black = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('object', 'color')
+
+
 class Opening(models.Model):
     """A chess opening record."""
     object = models.OneToOneField(Object, models.PROTECT, primary_key=True)
     moves = models.BinaryField(db_index=True)
     opening_name = models.CharField(max_length=50, unique=True, db_index=True)
+    # Deepest other opening whose moves are a prefix of this one.
+    parent = models.ForeignKey(
+        'self',
+        models.SET_NULL,
+        related_name="children",
+        null=True,
+    )
+    # Primary keys from the root of the tree to this opening, formatted
+    # with OPENING_PATH_FORMAT, so that descendants share a path prefix.
+    path = models.CharField(max_length=1000, default="", db_index=True)
 
     def __str__(self):
         return self.opening_name
 
+    def ancestor_ids(self):
+        """Primary keys of the opening and its ancestors, root first."""
+        return [int(pk) for pk in self.path.split("/") if pk]
+
+    def depth(self):
+        return max(len(self.ancestor_ids()) - 1, 0)
+
+    def related_ids(self):
+        """Objects whose page shows this opening, see `related_ids`."""
+        ids = related_ids(self.games())
+        ids.update(self.ancestor_ids())
+        ids.update(self.variations().values_list('object_id', flat=True))
+        return ids
+
     def moves_san(self):
-        binary_moves = [ord(x) for x in self.moves]
-        return pgn.san_moves(pgn.decode_moves(binary_moves))
+        return pgn.replay_moves(bytes(self.moves))[0]
 
     def games(self):
-        return Game.objects.filter(moves__chs_startswith=self.moves)
+        return Game.objects.filter(opening__path__startswith=self.path)
 
     def variations(self):
         return Opening.objects.filter(
-                moves__chs_startswith=self.moves
-            ).exclude(object_id=self.object_id)
+                path__startswith=self.path
+            ).exclude(object_id=self.object_id).order_by('path')
 
     def variation_of(self):
         return Opening.objects.filter(
-                moves__chs_startof=self.moves
-            ).exclude(object_id=self.object_id)
+                pk__in=self.ancestor_ids()
+            ).exclude(object_id=self.object_id).order_by('path')
 
     def delete(self):
+        declassify_opening(self, self.parent_id)
         obj = self.object
-        return super(Opening, self).delete() + obj.delete()
+        res = super(Opening, self).delete() + obj.delete()
+        rebuild_opening_tree()
+        return res
+
+
+OPENING_PATH_FORMAT = "%010d/"
+
+
+def rebuild_opening_tree(using=None):
+    """Recompute the parent and path of every opening.
+
+    Openings sorted by moves come right after their ancestors, so a single
+    pass with a stack of the current ancestors finds every parent. Only
+    changed rows are written, in the `using` database. Returns the ids of
+    the moved openings and of their old and new ancestors.
+    """
+    moved = set()
+    objects = Opening.objects.using(using)
+    with transaction.atomic(using=using):
+        openings = objects.select_for_update().order_by(
+                'moves', 'object_id'
+            ).values_list('object_id', 'moves', 'parent_id', 'path')
+        stack = []
+        for pk, moves, parent, path in openings:
+            moves = bytes(moves)
+            while stack and not moves.startswith(stack[-1][0]):
+                stack.pop()
+            if stack:
+                new_parent, new_path = stack[-1][1], stack[-1][2]
+            else:
+                new_parent, new_path = None, ""
+            new_path += OPENING_PATH_FORMAT % pk
+            if (new_parent, new_path) != (parent, path):
+                objects.filter(object_id=pk).update(
+                    parent=new_parent, path=new_path)
+                moved.update(
+                    int(a) for a in (path + new_path).split("/") if a)
+            stack.append((moves, pk, new_path))
+    return moved
+
+
+def deepest_opening(moves):
+    """The opening with the longest moves which are a prefix of `moves`."""
+    return Opening.objects.filter(
+            moves__chs_startof=moves
+        ).order_by(Length('moves').desc()).first()
+
+
+def classify_opening(opening):
+    """Classify games under a new or modified opening.
+
+    Games starting with the opening moves are moved to it, unless they are
+    already classified under a variation of it.
+    """
+    from . import stats
+    ancestors = opening.ancestor_ids()[:-1]
+    Game.objects.filter(
+        moves__chs_startswith=opening.moves
+    ).filter(
+        Q(opening=None) | Q(opening__in=ancestors)
+    ).update(opening=opening)
+    stats.refresh_openings(ancestors + [opening.object_id])
+    games_changed()
+
+
+def declassify_opening(opening, parent_id):
+    """Move games classified under an opening to its (former) parent."""
+    from . import stats
+    Game.objects.filter(opening=opening).update(opening=parent_id)
+    stats.refresh_openings([opening.object_id, parent_id])
+    games_changed()
+
+
+def reclassify_opening_games(opening):
+    """Classify again the games of an opening whose moves changed.
+
+    Each game goes to its deepest opening among all openings, as it may no
+    longer start with the opening moves. Returns the ids of the games which
+    changed opening.
+    """
+    from . import stats
+    trie = OpeningTrie.load()
+    changed = defaultdict(list)
+    games = Game.objects.filter(opening=opening).values_list(
+        'object_id', 'moves')
+    for pk, moves in games.iterator():
+        new = trie.classify(moves)
+        if new != opening.object_id:
+            changed[new].append(pk)
+    for new, ids in changed.items():
+        Game.objects.filter(object_id__in=ids).update(opening=new)
+    stats.refresh_openings(list(changed) + [opening.object_id])
+    games_changed()
+    return [pk for ids in changed.values() for pk in ids]
+
+
+class OpeningTrie(object):
+    """Openings indexed by moves, to classify games without queries."""
+
+    def __init__(self, openings):
+        """`openings` is a list of (primary key, moves) pairs."""
+        self.size = pgn.move_size()
+        self.root = {}
+        for pk, moves in openings:
+            node = self.root
+            moves = bytes(moves)
+            for i in range(0, len(moves), self.size):
+                node = node.setdefault(moves[i:i + self.size], {})
+            # The None key holds the opening ending at this node.
+            node[None] = pk
+
+    @classmethod
+    def load(cls):
+        return cls(Opening.objects.values_list('object_id', 'moves'))
+
+    def classify(self, moves):
+        """Primary key of the deepest opening `moves` start with, or None."""
+        moves = bytes(moves)
+        node = self.root
+        res = node.get(None)
+        for i in range(0, len(moves), self.size):
+            node = node.get(moves[i:i + self.size])
+            if node is None:
+                break
+            res = node.get(None, res)
+        return res
+
+
+class ImportCheckpoint(models.Model):
+    """Position reached in a pgn file by an unfinished import."""
+    path = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
+    # Version of the file the offset is in, see `file_version`.
+    size = models.BigIntegerField(default=0)
+    mtime = models.FloatField(default=0)
+    time = models.DateTimeField(auto_now=True)
+
+
+def file_version(path):
+    """Size and modification time of a file, as a tuple."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def checkpoint_offset(path):
+    """File position to resume an import from.
+
+    The import restarts from the beginning if the file was replaced or
+    modified since the checkpoint.
+    """
+    checkpoint = ImportCheckpoint.objects.filter(path=path).values_list(
+        'offset', 'size', 'mtime').first()
+    if checkpoint is None or checkpoint[1:] != file_version(path):
+        return 0
+    return checkpoint[0]
+
+
+def save_checkpoint(path, offset):
+    size, mtime = file_version(path)
+    ImportCheckpoint.objects.update_or_create(
+        path=path,
+        defaults={'offset': offset, 'size': size, 'mtime': mtime}
+    )
+
+
+def clear_checkpoint(path):
+    ImportCheckpoint.objects.filter(path=path).delete()
@@ -1,7 +1,21 @@
 import chess.pgn
+import chess.polyglot
+import django
+from django.conf import settings
+from django.db import connection, connections, transaction
+from . import explorer
 from . import models
+from . import stats
+from collections import deque, namedtuple
 from datetime import datetime
+from functools import lru_cache
 from io import StringIO
+import array
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
 
 
 def encode_move(move):
@@ -24,31 +38,146 @@ def decode_move(move):
         return chess.Move(move[0], move[1])
 
 
-def encode_moves(game):
-    """Encode a game moves into a bytes sequence."""
+# Move encodings: two bytes per move (`encode_move`), or one byte holding
+# the index of the move among the sorted legal moves of the position.
+WIDE = "wide"
+COMPACT = "compact"
+
+
+def move_encoding():
+    """The move encoding used in the database, see CHS_MOVE_ENCODING."""
+    return getattr(settings, "CHS_MOVE_ENCODING", WIDE)
+
+
+def move_size(encoding=None):
+    """Number of bytes per move in an encoding."""
+    return 1 if (encoding or move_encoding()) == COMPACT else 2
+
+
+def sorted_legal_moves(board):
+    """Legal moves of a position, in the order used by the compact encoding."""
+    return sorted(
+        board.legal_moves,
+        key=lambda m: (m.from_square, m.to_square, m.promotion or 0)
+    )
+
+
+def encode_compact_move(board, move):
+    """Encode a chess move played from `board` into one byte."""
+    return bytes([sorted_legal_moves(board).index(move)])
+
+
+def encode_move_list(moves, encoding=None):
+    """Encode a sequence of moves from the initial position."""
     res = bytearray()
-    for move in game.main_line():
-        res.extend(encode_move(move))
+    if (encoding or move_encoding()) == COMPACT:
+        board = chess.Board()
+        for move in moves:
+            res.extend(encode_compact_move(board, move))
+            board.push(move)
+    else:
+        for move in moves:
+            res.extend(encode_move(move))
     return bytes(res)
 
 
-def decode_moves(moves):
-    moves_iter = iter(moves)
-    list = []
-    while True:
-        try:
-            move = [next(moves_iter), next(moves_iter)]
-        except StopIteration:
-            return list
+def encode_moves(game):
+    """Encode a game moves into a bytes sequence."""
+    return encode_move_list(game.mainline_moves())
+
+
+@lru_cache(maxsize=None)
+def move_table():
+    """The moves for all two bytes codes, indexed by big endian code.
+
+    Invalid codes map to None.
+    """
+    table = [None] * 65536
+    for byte1 in range(128):
+        for byte2 in range(256):
+            if (byte1 < 64 and byte2 < 64) or byte1 > 64:
+                table[(byte1 << 8) | byte2] = decode_move((byte1, byte2))
+    return table
 
-        list.append(decode_move(move))
+
+def move_codes(moves):
+    """View a two bytes encoded moves sequence as an array of codes."""
+    codes = array.array('H', bytes(moves))
+    if sys.byteorder == 'little':
+        codes.byteswap()
+    return codes
+
+
+def decode_moves(moves, encoding=None):
+    """Decode a bytes sequence into a list of chess moves."""
+    if (encoding or move_encoding()) == COMPACT:
+        board = chess.Board()
+        res = []
+        for index in bytes(moves):
+            move = sorted_legal_moves(board)[index]
+            board.push(move)
+            res.append(move)
+        return res
+    table = move_table()
+    return [table[code] for code in move_codes(moves)]
 
 
 def encode_moves_from_uci(moves):
-    res = bytearray()
-    for move in moves:
-        res.extend(encode_move(chess.Move.from_uci(move)))
-    return bytes(res)
+    return encode_move_list(chess.Move.from_uci(move) for move in moves)
+
+
+def position_hash(board):
+    """Zobrist hash of a position, as a signed 64 bits integer."""
+    h = chess.polyglot.zobrist_hash(board)
+    return h - 2**64 if h >= 2**63 else h
+
+
+def position_hashes(moves):
+    """Hashes of the positions reached after each move of a game.
+
+    `moves` is an encoded moves sequence. The initial position, common to
+    all games, is not included.
+    """
+    board = chess.Board()
+    res = []
+    for move in decode_moves(moves):
+        board.push(move)
+        res.append(position_hash(board))
+    return res
+
+
+def parse_position(position):
+    """Parse a position given as a FEN, or as comma separated uci moves.
+
+    Raises ValueError if the position is invalid.
+    """
+    if "/" in position:
+        return chess.Board(position)
+    board = chess.Board()
+    for uci in position.split(","):
+        move = chess.Move.from_uci(uci.strip())
+        if not board.is_legal(move):
+            raise ValueError("illegal move " + uci)
+        board.push(move)
+    return board
+
+
+@lru_cache(maxsize=1024)
+def replay_moves(moves):
+    """San moves and fen positions of bytes encoded moves.
+
+    Returns a (san, fens) pair of tuples, where fens start with the initial
+    position. Results are cached, detail pages of the same game or opening
+    do not replay it again.
+    """
+    board = chess.Board()
+    san = []
+    fens = [board.fen()]
+    for move in decode_moves(moves):
+        san.append(board.san(move))
+        board.push(move)
+        fens.append(board.fen())
+    return tuple(san), tuple(fens)
 
 
 def san_moves(moves):
@@ -61,6 +190,47 @@ def san_moves(moves):
     return res
 
 
+def pgn_movetext(moves, result, width=80):
+    """Pgn movetext of a list of san moves, wrapped at `width` characters."""
+    tokens = []
+    for i, move in enumerate(moves):
+        if i % 2 == 0:
+            tokens.append("{}.".format(i // 2 + 1))
+        tokens.append(move)
+    tokens.append(result)
+
+    lines = []
+    line = ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > width:
+            lines.append(line)
+            line = token
+        else:
+            line = line + " " + token if line else token
+    lines.append(line)
+    return "\n".join(lines)
+
+
+def game_pgn(game):
+    """Pgn text of a game record, with the seven tag roster headers."""
+    date = game.start_date.strftime("%Y.%m.%d") if game.start_date else "????.??.??"
+    headers = [
+        ("Event", game.event.event_name if game.event else "?"),
+        ("Site", game.location or "?"),
+        ("Date", date),
+        ("Round", "?"),
+        ("White", game.white.pgn_str() if game.white else "?"),
+        ("Black", game.black.pgn_str() if game.black else "?"),
+        ("Result", game.result),
+    ]
+    text = "".join(
+        '[{} "{}"]\n'.format(name, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in headers
+    )
+    moves = san_moves(decode_moves(game.moves))
+    return text + "\n" + pgn_movetext(moves, game.result) + "\n\n"
+
+
 def parse_pgn_name_header(name):
     """Split a pgn name header as [firstname, lastname]."""
     if "," in name:
@@ -72,106 +242,419 @@ def parse_pgn_name_header(name):
         return ["", name]
 
 
-def load_game(game, owner):
-    """Add a chess game to the database."""
-    if game.headers["White"] == "?":
-        white = None
-    else:
-        try:
-            white_elo = int(game.headers["WhiteElo"])
-        except (ValueError, KeyError):
-            white_elo = None
-        white_name = parse_pgn_name_header(game.headers["White"])
-        white = models.find_or_add_player(
-            white_name[0],
-            white_name[1],
-            owner,
-            elo_rating=white_elo
-        )
+GameRecord = namedtuple("GameRecord", [
+    "white",  # (firstname, lastname, elo) or None
+    "black",  # (firstname, lastname, elo) or None
+    "event",  # (name, start date) or None
+    "location",
+    "date",
+    "result",
+    "moves",
+    "hash",  # see `game_hash`
+])
+
+
+def parse_pgn_date(date):
+    """Convert a pgn date to the django format, None if invalid."""
+    if "?" in date:
+        # just give up if date is not complete
+        return None
+    # validate date value
+    try:
+        datetime.strptime(date, "%Y.%m.%d")
+        # PGN uses YYYY.MM.DD, Django uses YYYY-MM-DD
+        return date.replace('.', '-')
+    except ValueError:
+        # Replace invalid date formats with NULL
+        print("Ignoring invalid date in pgn file : " + date)
+        return None
 
-    if game.headers["Black"] == "?":
-        black = None
-    else:
-        try:
-            black_elo = int(game.headers["BlackElo"])
-        except (ValueError, KeyError):
-            black_elo = None
-        black_name = parse_pgn_name_header(game.headers["Black"])
-        black = models.find_or_add_player(
-            black_name[0],
-            black_name[1],
-            owner,
-            elo_rating=black_elo
-        )
 
-    if game.headers["Event"] == "?":
+def parse_pgn_player(headers, color):
+    """Extract a player as (firstname, lastname, elo) from pgn headers."""
+    if headers[color] == "?":
+        return None
+    try:
+        elo = int(headers[color + "Elo"])
+    except (ValueError, KeyError):
+        elo = None
+    firstname, lastname = parse_pgn_name_header(headers[color])
+    return (firstname, lastname, elo)
+
+
+def game_hash(white, black, event, date, result, moves):
+    """Identify a game by its content, as a hex digest.
+
+    Players are given as (firstname, lastname, ...) tuples and the event as
+    a (name, ...) tuple, any of which may be None.
+    """
+    fields = [
+        white[0] if white else "",
+        white[1] if white else "",
+        black[0] if black else "",
+        black[1] if black else "",
+        event[0] if event else "",
+        date or "",
+        result,
+    ]
+    h = hashlib.sha1(bytes(moves))
+    h.update("\0".join(fields).encode())
+    return h.hexdigest()
+
+
+def game_record(headers, moves):
+    """Extract the values stored in the database from a pgn game."""
+    if headers["Event"] == "?":
         event = None
     else:
-        if "EventDate" in game.headers and "?" not in game.headers["EventDate"]:
-            # validate date value
-            try:
-                datetime.strptime(game.headers["EventDate"], "%Y.%m.%d")
-                # PGN uses YYYY.MM.DD, Django uses YYYY-MM-DD
-                event_date = game.headers["EventDate"].replace('.', '-')
-            except ValueError:
-                # Replace invalid date formats with NULL
-                print("Ignoring invalid date in pgn file : "
-                      + game.headers["EventDate"])
-                event_date = None
-        else:
-            event_date = None
+        event_date = parse_pgn_date(headers.get("EventDate", "?"))
+        event = (headers["Event"], event_date)
 
-        event = models.find_or_add_event(
-            game.headers["Event"],
-            owner,
-            start_date=event_date
-        )
-
-    if game.headers["Site"] == "?":
+    if headers["Site"] == "?":
         location = None
     else:
-        location = game.headers["Site"]
+        location = headers["Site"]
 
-    if "?" in game.headers["Date"]:
-        # just give up if date is not complete
-        date = None
-    else:
-        # validate date value
-        try:
-            datetime.strptime(game.headers["Date"], "%Y.%m.%d")
-            # PGN uses YYYY.MM.DD, Django uses YYYY-MM-DD
-            date = game.headers["Date"].replace('.', '-')
-        except ValueError:
-            # Replace invalid date formats with NULL
-            print("Ignoring invalid date in pgn file : "
-                  + game.headers["Date"])
-            date = None
-
-    obj = models.create_obj(owner)
-    g = models.Game(
-        object=obj,
-        moves=encode_moves(game),
+    white = parse_pgn_player(headers, "White")
+    black = parse_pgn_player(headers, "Black")
+    date = parse_pgn_date(headers["Date"])
+    result = headers["Result"]
+    return GameRecord(
         white=white,
         black=black,
-        result=game.headers["Result"],
         event=event,
         location=location,
-        start_date=date
+        date=date,
+        result=result,
+        moves=moves,
+        hash=game_hash(white, black, event, date, result, moves),
     )
-    g.save()
-    return g, obj
 
 
-def load_file(file, owner):
-    """Add games from a pgn file to the database."""
+# Headers used by `game_record`, with the default values of the seven tag
+# roster for missing ones.
+RECORD_HEADERS = {
+    "Event": "?",
+    "EventDate": "?",
+    "Site": "?",
+    "Date": "????.??.??",
+    "White": "?",
+    "WhiteElo": "?",
+    "Black": "?",
+    "BlackElo": "?",
+    "Result": "*",
+}
+
+# Recent versions of python-chess can skip variations without parsing them.
+SKIP = getattr(chess.pgn, "SKIP", None)
+
+
+class RecordVisitor(chess.pgn.BaseVisitor):
+    """A pgn visitor producing a `GameRecord` instead of a game tree.
+
+    Only the headers listed in `RECORD_HEADERS` are kept, mainline moves are
+    encoded as they are read, and variations, comments and nags are dropped.
+    """
+
+    def begin_game(self):
+        self.headers = dict(RECORD_HEADERS)
+        self.moves = bytearray()
+        self.variation_depth = 0
+        self.compact = move_encoding() == COMPACT
+
+    def visit_header(self, tagname, tagvalue):
+        if tagname in self.headers:
+            self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        # end_variation is called for skipped variations too.
+        self.variation_depth += 1
+        return SKIP
+
+    def end_variation(self):
+        self.variation_depth -= 1
+
+    def visit_move(self, board, move):
+        if self.variation_depth:
+            return
+        if self.compact:
+            self.moves.extend(encode_compact_move(board, move))
+        else:
+            self.moves.extend(encode_move(move))
+
+    def handle_error(self, error):
+        # Keep what was parsed so far, like the default game builder.
+        pass
+
+    def result(self):
+        return game_record(self.headers, bytes(self.moves))
+
+
+def read_record(handle):
+    """Read the next game of a pgn file as a `GameRecord`, None at the end."""
+    return chess.pgn.read_game(handle, Visitor=RecordVisitor)
+
+
+def load_record(record, owner, cache=None):
+    """Add a chess game record to the database.
+
+    Returns None if the game is already in the database.
+    """
+    games = load_batch([record], owner, cache)
+    if not games:
+        return None
+    return games[0], games[0].object
+
+
+def load_game(game, owner, cache=None):
+    """Add a chess game to the database."""
+    record = game_record(game.headers, encode_moves(game))
+    return load_record(record, owner, cache)
+
+
+def load_batch(records, owner, cache=None):
+    """Add a list of chess game records to the database.
+
+    Players, events and games are written with bulk inserts, in a single
+    transaction. Known player and event names are looked up in `cache`
+    first, if given. Games already in the database are skipped. Returns the
+    list of games added.
+    """
+    if cache is None:
+        cache = models.ImportCache(0)
+    with transaction.atomic():
+        known = set(models.Game.objects.filter(
+                content_hash__in=[r.hash for r in records]
+            ).values_list('content_hash', flat=True))
+        new = []
+        for record in records:
+            if record.hash not in known:
+                known.add(record.hash)
+                new.append(record)
+        records = new
+
+        # In game order, so that a new player gets the elo of their first
+        # game, as when games are added one by one.
+        players = models.find_or_add_players(
+            [p for r in records for p in (r.white, r.black) if p],
+            owner,
+            cache
+        )
+        events = models.find_or_add_events(
+            [r.event for r in records if r.event],
+            owner,
+            cache
+        )
+
+        openings = cache.opening_trie()
+        objs = models.create_objs(owner, len(records), models.Object.GAME)
+        games = []
+        for obj, record in zip(objs, records):
+            games.append(models.Game(
+                object=obj,
+                moves=record.moves,
+                white_id=players[record.white[:2]] if record.white else None,
+                black_id=players[record.black[:2]] if record.black else None,
+                result=record.result,
+                event_id=events[record.event[0]] if record.event else None,
+                location=record.location,
+                start_date=record.date,
+                content_hash=record.hash,
+                opening_id=openings.classify(record.moves)
+            ))
+        models.Game.objects.bulk_create(games)
+        models.Position.objects.bulk_create(
+            [
+                models.Position(zobrist=h, game_id=game.object_id, ply=ply)
+                for game, record in zip(games, records)
+                for ply, h in enumerate(position_hashes(record.moves), 1)
+            ],
+            batch_size=10000
+        )
+        with connection.cursor() as cursor:
+            models.index_sides(
+                cursor,
+                "(SELECT * FROM chs_game WHERE object_id = ANY(%s))",
+                [[game.object_id for game in games]]
+            )
+        explorer.record_games([(r.moves, r.result) for r in records])
+        stats.record_games([stats.game_key(game) for game in games])
+        models.bump_versions(models.related_ids(models.Game.objects.filter(
+            object_id__in=[game.object_id for game in games])))
+    models.games_changed()
+    return games
+
+
+def throughput(count, start):
+    """Message reporting the rate of a load of `count` games since `start`."""
+    elapsed = time.time() - start
+    rate = count / elapsed if elapsed > 0 else 0
+    return "Loaded {} games in {:.1f}s ({:.1f} games/sec)".format(
+        count, elapsed, rate)
+
+
+def load_file(file, owner, batch_size=None, stdout=None, warm_cache=True,
+              resume=True):
+    """Add games from a pgn file to the database.
+
+    If `batch_size` is set, games are inserted by batches of that size,
+    with one transaction per batch. The file position reached is then saved
+    after each batch, and an import of the same file resumes from there
+    when `resume` is set. Player and event names are resolved through an
+    import cache, filled from the database at the start when `warm_cache`
+    is set. The throughput is written to `stdout` at the end, if given.
+    Returns the number of games read.
+    """
+    start = time.time()
+    cache = models.ImportCache()
+    if warm_cache:
+        cache.warm()
+    count = 0
+
+    if not batch_size:
+        while True:
+            record = read_record(file)
+            if not record:
+                break
+            count += 1
+            load_record(record, owner, cache)
+    else:
+        path = None
+        if isinstance(getattr(file, "name", None), str):
+            path = os.path.abspath(file.name)
+            if resume:
+                file.seek(models.checkpoint_offset(path))
+        for records, offset in read_chunks(file, batch_size):
+            with transaction.atomic():
+                load_batch(records, owner, cache)
+                if path:
+                    models.save_checkpoint(path, offset)
+            count += len(records)
+        if path:
+            models.clear_checkpoint(path)
+
+    if stdout is not None:
+        stdout.write(throughput(count, start))
+    return count
+
+
+def split_games(file, games_per_chunk, offset=0):
+    """Split a pgn file opened in binary mode into chunks of whole games.
+
+    Yields (chunk, offset) pairs, where offset is the position in the file
+    of the end of the chunk. `offset` is the initial position of the file.
+    """
+    chunk = []
+    games = 0
+    for line in file:
+        if line.startswith(b"[Event "):
+            if games == games_per_chunk:
+                yield b"".join(chunk), offset
+                chunk = []
+                games = 0
+            games += 1
+        chunk.append(line)
+        offset += len(line)
+    if chunk:
+        yield b"".join(chunk), offset
+
+
+def parse_chunk(chunk, encoding):
+    """Parse a chunk of pgn text into a list of game records."""
+    handle = StringIO(chunk.decode(encoding))
+    records = []
     while True:
-        game = chess.pgn.read_game(file)
-        if not game:
+        record = read_record(handle)
+        if not record:
+            return records
+        records.append(record)
+
+
+def read_chunks(file, games_per_chunk):
+    """Read a pgn file as lists of at most `games_per_chunk` game records.
+
+    Yields (records, offset) pairs, where offset is the file position at
+    the end of the chunk.
+    """
+    records = []
+    while True:
+        record = read_record(file)
+        if not record:
             break
-        load_game(game, owner)
+        records.append(record)
+        if len(records) >= games_per_chunk:
+            yield records, file.tell()
+            records = []
+    if records:
+        yield records, file.tell()
+
+
+def read_chunks_parallel(path, encoding, processes, games_per_chunk, offset=0):
+    """Parallel version of `read_chunks`, taking a file path.
+
+    The file is split into chunks of `games_per_chunk` games, starting at
+    byte `offset`, which are parsed by a pool of `processes` workers.
+    Chunks are yielded in file order.
+    """
+    # Forked workers must not inherit the open database connection.
+    connections.close_all()
+    pending = deque()
+    # Workers started with spawn (the default on macOS and Windows) import
+    # this module anew, which needs Django to be set up first.
+    pool = multiprocessing.Pool(processes, initializer=django.setup)
+    with open(path, "rb") as file, pool:
+        file.seek(offset)
+        for chunk, end in split_games(file, games_per_chunk, offset):
+            result = pool.apply_async(parse_chunk, (chunk, encoding))
+            pending.append((result, end))
+            # Bound the number of chunks held in memory.
+            if len(pending) > 2 * processes:
+                result, end = pending.popleft()
+                yield result.get(), end
+        while pending:
+            result, end = pending.popleft()
+            yield result.get(), end
+
+
+def load_file_parallel(path, owner, encoding="utf-8", processes=None,
+                       batch_size=1000, stdout=None, resume=True):
+    """Add games from a pgn file to the database, parsing in parallel.
+
+    Chunks of `batch_size` games are parsed by a pool of `processes` workers.
+    The calling process is the only one writing to the database, one batch
+    per chunk, in file order. Progress is saved and reported as in
+    `load_file`. Returns the number of games read.
+    """
+    start = time.time()
+    processes = processes or os.cpu_count()
+    cache = models.ImportCache()
+    cache.warm()
+    path = os.path.abspath(path)
+    offset = models.checkpoint_offset(path) if resume else 0
+
+    count = 0
+    chunks = read_chunks_parallel(path, encoding, processes, batch_size, offset)
+    for records, offset in chunks:
+        with transaction.atomic():
+            load_batch(records, owner, cache)
+            models.save_checkpoint(path, offset)
+        count += len(records)
+    models.clear_checkpoint(path)
+
+    if stdout is not None:
+        stdout.write(throughput(count, start))
+    return count
+
+
+# Games of a pgn string loaded per batch, see `load_string`.
+STRING_BATCH_SIZE = 1000
 
 
 def load_string(str, owner):
-    """Add games from a pgn string to the database."""
+    """Add games from a pgn string to the database.
+
+    Games are loaded in batches, so that a string of a few games costs the
+    queries of a single `load_batch`.
+    """
     pgn = StringIO(str)
-    load_file(pgn, owner)
+    load_file(pgn, owner, batch_size=STRING_BATCH_SIZE, warm_cache=False)
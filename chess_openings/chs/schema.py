@@ -0,0 +1,97 @@
+from django.core.management import call_command
+from django.db import connections
+from . import models
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# (table, column) pairs searched by substring, with a pg_trgm index.
+TRIGRAM_INDEXES = [
+    ('chs_player', 'firstname'),
+    ('chs_player', 'lastname'),
+    ('chs_event', 'event_name'),
+    ('chs_event', 'location'),
+    ('chs_game', 'location'),
+    ('chs_gameside', 'firstname'),
+    ('chs_gameside', 'lastname'),
+]
+
+# Case insensitive name lookups of the game search.
+EXPRESSION_INDEXES_SQL = """
+CREATE INDEX IF NOT EXISTS chs_gameside_upper_lastname
+ON chs_gameside (upper(lastname::text), start_date);
+
+CREATE INDEX IF NOT EXISTS chs_gameside_upper_firstname
+ON chs_gameside (upper(firstname::text), start_date);
+"""
+
+# Sets the kind of objects created before it existed.
+BACKFILL_KINDS_SQL = """
+UPDATE chs_object SET kind = %s
+WHERE kind = '' AND id IN (SELECT object_id FROM {table})
+"""
+
+# Model table of each object kind.
+KIND_TABLES = [
+    ('game', 'chs_game'),
+    ('player', 'chs_player'),
+    ('event', 'chs_event'),
+    ('opening', 'chs_opening'),
+]
+
+TRIGRAM_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS {table}_{column}_trgm
+ON {table} USING gin ({column} gin_trgm_ops)
+"""
+
+
+def create_schema(using, **kwargs):
+    """Create the database objects Django models can not describe, and fill
+    columns added to existing tables.
+
+    Connected to the post_migrate signal. Statements are idempotent, so they
+    run after every migration.
+
+    The substring and fuzzy searches need the pg_trgm extension, shipped in
+    the postgresql contrib package. When the server does not have it, its
+    indexes are skipped with a warning and fuzzy player search fails.
+    """
+    connection = connections[using]
+    # Table of the 'shared' cache.
+    call_command('createcachetable', database=using)
+    with connection.cursor() as cursor:
+        for kind, table in KIND_TABLES:
+            cursor.execute(BACKFILL_KINDS_SQL.format(table=table), [kind])
+    # Fills the path of openings created before the opening tree.
+    models.rebuild_opening_tree(using)
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        if create_trigram_extension(cursor):
+            for table, column in TRIGRAM_INDEXES:
+                cursor.execute(
+                    TRIGRAM_INDEX_SQL.format(table=table, column=column))
+        else:
+            logger.warning(
+                "The pg_trgm extension is not available, trigram indexes "
+                "are not created.")
+        cursor.execute(EXPRESSION_INDEXES_SQL)
+
+
+def create_trigram_extension(cursor):
+    """Create pg_trgm unless it exists, False if the server does not have it.
+
+    Creating it needs rights the database owner may not have, so it is only
+    attempted when the extension is not installed yet.
+    """
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    if cursor.fetchone():
+        return True
+    cursor.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    if not cursor.fetchone():
+        return False
+    cursor.execute("CREATE EXTENSION pg_trgm")
+    return True
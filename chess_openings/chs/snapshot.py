@@ -0,0 +1,106 @@
+from . import pgn
+import json
+import numpy as np
+import os
+
+
+# Columns of a snapshot, one .npy file each. Missing ids and ratings are -1.
+COLUMNS = {
+    'ids': np.int32,
+    'dates': 'datetime64[D]',
+    'results': np.int8,
+    'white': np.int32,
+    'black': np.int32,
+    'white_elo': np.int16,
+    'black_elo': np.int16,
+    'events': np.int32,
+    'openings': np.int32,
+}
+
+RESULT_CODES = {'1-0': 0, '1/2-1/2': 1, '0-1': 2, '*': 3}
+
+
+def create(directory, count, moves_size, encoding):
+    """Create an empty snapshot of `count` games, as writable memmaps.
+
+    `moves_size` is the total length of the encoded moves. Returns a dict of
+    arrays, with `moves` and `offsets` added to the columns.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "meta.json"), "w") as file:
+        json.dump({
+            'games': count,
+            'encoding': encoding,
+            'results': RESULT_CODES,
+        }, file)
+
+    def array(name, dtype, length):
+        return np.lib.format.open_memmap(
+            os.path.join(directory, name + ".npy"),
+            mode="w+", dtype=dtype, shape=(length,))
+
+    res = {name: array(name, dtype, count) for name, dtype in COLUMNS.items()}
+    res['moves'] = array('moves', np.uint8, moves_size)
+    res['offsets'] = array('offsets', np.int64, count + 1)
+    return res
+
+
+class Snapshot(object):
+    """A snapshot written by the export_snapshot command.
+
+    Columns are memory mapped read only arrays, loaded on access. The moves
+    of game i are moves[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as file:
+            self.meta = json.load(file)
+        for name in list(COLUMNS) + ['moves', 'offsets']:
+            setattr(self, name, np.load(
+                os.path.join(directory, name + ".npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return self.meta['games']
+
+    def game_moves(self, i):
+        """Decoded moves of game i."""
+        data = self.moves[self.offsets[i]:self.offsets[i + 1]].tobytes()
+        return pgn.decode_moves(data, self.meta['encoding'])
+
+
+def result_counts(results, groups, size):
+    """Number of each result per group, as a (size, 4) array."""
+    return np.bincount(
+        groups * len(RESULT_CODES) + results,
+        minlength=size * len(RESULT_CODES)
+    ).reshape(size, len(RESULT_CODES))
+
+
+def results_by_elo(snapshot, band=100):
+    """Result counts by average rating of the players.
+
+    Only games with both ratings known are counted. Returns (bands, counts)
+    where bands are the lower bounds of the rating bands, and counts[i] the
+    number of white wins, draws, black wins and unfinished games of band i.
+    """
+    white = snapshot.white_elo.astype(np.int32)
+    black = snapshot.black_elo.astype(np.int32)
+    rated = (white >= 0) & (black >= 0)
+    groups = (white[rated] + black[rated]) // 2 // band
+    if not len(groups):
+        return np.zeros(0, np.int32), np.zeros((0, len(RESULT_CODES)), np.int64)
+    low = groups.min()
+    counts = result_counts(
+        snapshot.results[rated], groups - low, groups.max() - low + 1)
+    bands = (np.arange(len(counts)) + low) * band
+    return bands, counts
+
+
+def opening_popularity(snapshot, limit=20):
+    """Most played openings, as (opening ids, game counts) arrays."""
+    openings = snapshot.openings[snapshot.openings >= 0]
+    counts = np.bincount(openings)
+    top = np.argsort(counts)[::-1][:limit]
+    top = top[counts[top] > 0]
+    return top, counts[top]
@@ -0,0 +1,117 @@
+from django.db import connection
+from django.db.models import Sum
+from . import counters
+from . import models
+
+
+KEYS = ('object_id', 'color')
+
+# Counts every game of `table` (a table or query with the columns of
+# chs_game) in the counters, set-based.
+RECORD_TABLE_SQL = """
+SELECT s.id, s.color, {counts}
+FROM {table} AS g
+CROSS JOIN LATERAL (VALUES
+    (g.white_id, 'w'), (g.black_id, 'b'), (g.event_id, ''), (g.opening_id, '')
+) AS s (id, color)
+WHERE s.id IS NOT NULL
+GROUP BY 1, 2
+"""
+
+
+def game_key(game):
+    """The fields of a game the counters depend on."""
+    return (game.white_id, game.black_id, game.event_id, game.opening_id,
+            game.result)
+
+
+def record_games(games, sign=1):
+    """Add (or remove, with sign=-1) games to the counters.
+
+    `games` is a list of `game_key` tuples.
+    """
+    counts = counters.counts()
+    for white, black, event, opening, result in games:
+        for pk, color in ((white, 'w'), (black, 'b'), (event, ''),
+                          (opening, '')):
+            if pk is not None:
+                counters.count(counts[(pk, color)], result, sign)
+    counters.add('chs_resultstat', KEYS, ('integer', 'text'), counts)
+
+
+def record_sql(table):
+    """Statement adding the games of `table` to the counters."""
+    select = RECORD_TABLE_SQL.format(
+        table=table, counts=counters.RESULT_COUNTS_SQL)
+    return counters.upsert_sql('chs_resultstat', KEYS, select)
+
+
+def record_table(cursor, table):
+    """Add all games of a SQL table or subquery to the counters."""
+    cursor.execute(record_sql(table))
+
+
+def refresh_openings(ids):
+    """Recount the games of openings, after games were reclassified."""
+    ids = [pk for pk in ids if pk is not None]
+    models.ResultStat.objects.filter(object_id__in=ids).delete()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            record_sql("""(
+                SELECT NULL::integer AS white_id, NULL::integer AS black_id,
+                    NULL::integer AS event_id, opening_id, result
+                FROM chs_game WHERE opening_id = ANY(%s)
+            )"""),
+            [ids]
+        )
+
+
+def totals(rows):
+    """Sum of (games, white, draws, black) counters, as a dict."""
+    res = rows.aggregate(
+        games=Sum('games'), white=Sum('white'), draws=Sum('draws'),
+        black=Sum('black'))
+    return {key: value or 0 for key, value in res.items()}
+
+
+def side_results(counters, color):
+    """Wins, draws and losses of one side from result counters."""
+    wins, losses = ('white', 'black') if color == 'w' else ('black', 'white')
+    return {
+        'games': counters['games'],
+        'wins': counters[wins],
+        'draws': counters['draws'],
+        'losses': counters[losses],
+    }
+
+
+def player_results(player):
+    """Results of a player, as white, as black and in total."""
+    rows = {
+        row['color']: row for row in models.ResultStat.objects.filter(
+            object_id=player.object_id
+        ).values('color', 'games', 'white', 'draws', 'black')
+    }
+    empty = {'games': 0, 'white': 0, 'draws': 0, 'black': 0}
+    res = {
+        'white': side_results(rows.get('w', empty), 'w'),
+        'black': side_results(rows.get('b', empty), 'b'),
+    }
+    res['total'] = {
+        key: res['white'][key] + res['black'][key]
+        for key in ('games', 'wins', 'draws', 'losses')
+    }
+    return res
+
+
+def event_results(event):
+    return totals(models.ResultStat.objects.filter(object_id=event.object_id))
+
+
+def opening_results(opening):
+    """Results of the games of an opening and its variations."""
+    return totals(models.ResultStat.objects.filter(
+        object_id__in=models.Opening.objects.filter(
+            path__startswith=opening.path
+        ).values('object_id')
+    ))
@@ -1,3 +1,1406 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from io import BytesIO, StringIO
+from unittest import mock
+import chess
+import chess.pgn
+import hashlib
+import numpy as np
+import os
+import random
+import re
+import tempfile
 
-# Create your tests here.
+from . import codec
+from . import metrics
+from . import models
+from . import pgn
+from . import schema
+from . import snapshot
+from . import urls
+from . import views
+
+
+# Number of games, black players and comments of the fixture. The white
+# player plays all games, and each event half of them. It is larger than
+# every budget, so that a query per row always goes over.
+FIXTURE_SIZE = 64
+
+GAME_PGN = """[Event "Tournament {event}"]
+[Site "Paris"]
+[Date "{date}"]
+[White "White, Anna"]
+[Black "Black{i}, Boris"]
+[Result "1-0"]
+[WhiteElo "2400"]
+[BlackElo "2300"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 1-0
+
+"""
+
+# Maximum number of queries of a request to each url, as
+# (method, fixture, data, budget). The url takes the primary key of the
+# fixture object if it has a pk argument, it is sent as the `id` field of
+# the form otherwise. Requests are made logged in as the owner of the
+# fixture, with an empty cache.
+QUERY_BUDGETS = {
+    'mainpage': ('get', None, {}, 4),
+    'game': ('get', 'game', {}, 8),
+    'game_list': ('get', None, {}, 8),
+    'game_search': ('get', None, {}, 4),
+    'game_export': ('get', None, {}, 4),
+    'game_create': ('get', None, {}, 4),
+    'game_add': ('post', None, {
+        'moves': "d2d4,d7d5", 'result': "1-0", 'event': "Tournament 0",
+        'location': "", 'date': "", 'white_first': "Anna",
+        'white_last': "White", 'black_first': "Carl", 'black_last': "New",
+    }, 50),
+    'game_add_pgn': ('post', None, {
+        'pgn': GAME_PGN.format(
+            event=2, date="2100.01.01", i=FIXTURE_SIZE),
+    }, 60),
+    'game_edit': ('get', 'game', {}, 6),
+    'game_delete': ('get', 'game', {}, 40),
+    'player': ('get', 'player', {}, 10),
+    'player_list': ('get', None, {}, 6),
+    'player_search': ('get', None, {}, 4),
+    'player_create': ('get', None, {}, 4),
+    'player_add': ('post', 'player', {
+        'firstname': "Anna", 'lastname': "Renamed", 'elo': "2450",
+        'nationality': "FRA",
+    }, 40),
+    'player_edit': ('get', 'player', {}, 4),
+    'player_delete': ('get', 'player', {}, 50),
+    'event': ('get', 'event', {}, 10),
+    'event_list': ('get', None, {}, 6),
+    'event_search': ('get', None, {}, 4),
+    'event_create': ('get', None, {}, 4),
+    'event_add': ('post', 'event', {
+        'event_name': "Renamed", 'location': "Paris", 'start_date': "",
+        'end_date': "",
+    }, 40),
+    'event_edit': ('get', 'event', {}, 4),
+    'event_delete': ('get', 'event', {}, 50),
+    'opening': ('get', 'opening', {}, 12),
+    'opening_list': ('get', None, {}, 6),
+    'opening_search': ('get', None, {}, 4),
+    'opening_create': ('get', None, {}, 4),
+    'opening_add': ('post', None, {
+        'moves': "d2d4,d7d5", 'opening_name': "Closed Game",
+    }, 40),
+    'opening_edit': ('get', 'opening', {}, 4),
+    'opening_delete': ('get', 'opening', {}, 40),
+    'explorer': ('get', None, {'moves': "e2e4"}, 4),
+    'metrics': ('get', None, {}, 3),
+    'object': ('get', 'game', {}, 3),
+    'comment': ('post', 'game', {'comment_text': "Nice game"}, 8),
+    'login': ('get', None, {}, 4),
+    'handle_login': ('post', None, {
+        'account': "owner", 'password': "secret",
+    }, 6),
+    'logout': ('get', None, {}, 6),
+    'register': ('get', None, {}, 4),
+    'handle_register': ('post', None, {
+        'account': "newcomer", 'password': "secret",
+    }, 8),
+    'account': ('get', None, {}, 4),
+    'change_password': ('post', None, {
+        'old_password': "secret", 'password': "changed",
+    }, 6),
+}
+
+
+def create_account(pseudo, password):
+    salt = os.urandom(64)
+    account = models.Account(
+        pseudo=pseudo,
+        password=hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000),
+        salt=salt
+    )
+    account.save()
+    return account
+
+
+def create_opening(owner, moves, name):
+    opening = models.Opening(
+        object=models.create_obj(owner, models.Object.OPENING),
+        moves=pgn.encode_moves_from_uci(moves),
+        opening_name=name
+    )
+    opening.save()
+    return opening
+
+
+def login(client, account):
+    session = client.session
+    session['account'] = account.id
+    session.save()
+    client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+
+class QueryBudgetTest(TestCase):
+    """Check that no page runs more queries than its budget.
+
+    There is one test per url name, see `QUERY_BUDGETS`.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = create_account("owner", "secret")
+        create_opening(cls.account, ["e2e4", "e7e5"], "Open Game")
+        create_opening(cls.account, ["e2e4", "e7e5", "g1f3"], "King's Knight")
+        models.rebuild_opening_tree()
+        pgn.load_string("".join(
+            GAME_PGN.format(
+                event=i % 2, date="{}.01.01".format(1950 + i), i=i)
+            for i in range(FIXTURE_SIZE)
+        ), cls.account)
+
+        cls.game = models.Game.objects.order_by('pk').first()
+        cls.player = cls.game.white
+        cls.event = cls.game.event
+        cls.opening = models.Opening.objects.order_by('path').first()
+        models.Comment.objects.bulk_create([
+            models.Comment(account=cls.account, object=cls.game.object,
+                           text="comment {}".format(i))
+            for i in range(FIXTURE_SIZE)
+        ])
+        # Set once, by the first game list shown after a deployment.
+        models.games_generation()
+
+    def setUp(self):
+        caches['default'].clear()
+        login(self.client, self.account)
+
+    def test_all_urls_have_budget(self):
+        names = set(pattern.name for pattern in urls.urlpatterns)
+        self.assertEqual(names, set(QUERY_BUDGETS))
+
+    def check_budget(self, name):
+        method, fixture, data, budget = QUERY_BUDGETS[name]
+        pattern = next(p for p in urls.urlpatterns if p.name == name)
+        data = dict(data)
+        args = ()
+        if fixture is not None:
+            pk = getattr(self, fixture).pk
+            if 'pk' in pattern.regex.groupindex:
+                args = (pk,)
+            else:
+                data['id'] = pk
+        url = reverse('chess:' + name, args=args)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data)
+            if response.streaming:
+                b"".join(response.streaming_content)
+        self.assertLess(response.status_code, 400)
+        self.assertLessEqual(
+            len(queries), budget,
+            "{} ran {} queries:\n{}".format(url, len(queries), "\n".join(
+                query['sql'] for query in queries.captured_queries))
+        )
+
+    def test_mainpage(self):
+        self.check_budget('mainpage')
+
+    def test_game(self):
+        self.check_budget('game')
+
+    def test_game_list(self):
+        self.check_budget('game_list')
+
+    def test_game_search(self):
+        self.check_budget('game_search')
+
+    def test_game_export(self):
+        self.check_budget('game_export')
+
+    def test_game_create(self):
+        self.check_budget('game_create')
+
+    def test_game_add(self):
+        self.check_budget('game_add')
+
+    def test_game_add_pgn(self):
+        self.check_budget('game_add_pgn')
+
+    def test_game_edit(self):
+        self.check_budget('game_edit')
+
+    def test_game_delete(self):
+        self.check_budget('game_delete')
+
+    def test_player(self):
+        self.check_budget('player')
+
+    def test_player_list(self):
+        self.check_budget('player_list')
+
+    def test_player_search(self):
+        self.check_budget('player_search')
+
+    def test_player_create(self):
+        self.check_budget('player_create')
+
+    def test_player_add(self):
+        self.check_budget('player_add')
+
+    def test_player_edit(self):
+        self.check_budget('player_edit')
+
+    def test_player_delete(self):
+        self.check_budget('player_delete')
+
+    def test_event(self):
+        self.check_budget('event')
+
+    def test_event_list(self):
+        self.check_budget('event_list')
+
+    def test_event_search(self):
+        self.check_budget('event_search')
+
+    def test_event_create(self):
+        self.check_budget('event_create')
+
+    def test_event_add(self):
+        self.check_budget('event_add')
+
+    def test_event_edit(self):
+        self.check_budget('event_edit')
+
+    def test_event_delete(self):
+        self.check_budget('event_delete')
+
+    def test_opening(self):
+        self.check_budget('opening')
+
+    def test_opening_list(self):
+        self.check_budget('opening_list')
+
+    def test_opening_search(self):
+        self.check_budget('opening_search')
+
+    def test_opening_create(self):
+        self.check_budget('opening_create')
+
+    def test_opening_add(self):
+        self.check_budget('opening_add')
+
+    def test_opening_edit(self):
+        self.check_budget('opening_edit')
+
+    def test_opening_delete(self):
+        self.check_budget('opening_delete')
+
+    def test_explorer(self):
+        self.check_budget('explorer')
+
+    def test_metrics(self):
+        self.check_budget('metrics')
+
+    def test_object(self):
+        self.check_budget('object')
+
+    def test_comment(self):
+        self.check_budget('comment')
+
+    def test_login(self):
+        self.check_budget('login')
+
+    def test_handle_login(self):
+        self.check_budget('handle_login')
+
+    def test_logout(self):
+        self.check_budget('logout')
+
+    def test_register(self):
+        self.check_budget('register')
+
+    def test_handle_register(self):
+        self.check_budget('handle_register')
+
+    def test_account(self):
+        self.check_budget('account')
+
+    def test_change_password(self):
+        self.check_budget('change_password')
+
+
+def metric(name, view):
+    """Value of a metric of a view in the /metrics output, 0 if missing."""
+    match = re.search(
+        r'^{}{{view="{}"}} (\S+)$'.format(re.escape(name), re.escape(view)),
+        metrics.render(), re.M)
+    return float(match.group(1)) if match else 0
+
+
+class MetricsTest(TestCase):
+    """Request metrics and their endpoint."""
+
+    def get(self, sample_rate, **settings):
+        with self.settings(CHS_METRICS_SQL_SAMPLE_RATE=sample_rate,
+                           **settings):
+            return self.client.get(reverse('chess:mainpage'))
+
+    def test_slowest_statements(self):
+        stats = metrics.RequestStats(keep=3)
+        durations = [0.5, 0.1, 0.9, 0.3, 0.7, 0.2]
+        for i, duration in enumerate(durations):
+            stats.add_query("SELECT {}".format(i), duration)
+        self.assertEqual(stats.queries, 6)
+        self.assertAlmostEqual(stats.sql_time, sum(durations))
+        self.assertEqual(stats.slowest(), [
+            (0.9, "SELECT 2"), (0.7, "SELECT 4"), (0.5, "SELECT 0")])
+
+    def test_sampling(self):
+        view = 'chess:mainpage'
+        requests = metric("chs_request_duration_seconds_count", view)
+        sampled = metric("chs_request_queries_count", view)
+        self.get(1)
+        self.assertEqual(
+            metric("chs_request_queries_count", view), sampled + 1)
+        self.get(0)
+        self.assertEqual(
+            metric("chs_request_duration_seconds_count", view), requests + 2)
+        if not hasattr(connection, 'execute_wrapper'):
+            self.assertEqual(
+                metric("chs_request_queries_count", view), sampled + 1)
+
+    def test_slow_requests(self):
+        with self.assertLogs('chs.middleware', 'WARNING') as logs:
+            self.get(1, CHS_SLOW_REQUEST_SECONDS=0)
+        self.assertIn("Slow request GET / (chess:mainpage)", logs.output[0])
+        with self.assertLogs('chs.middleware', 'WARNING') as logs:
+            self.get(0, CHS_SLOW_REQUEST_SECONDS=0)
+        if not hasattr(connection, 'execute_wrapper'):
+            self.assertIn("queries not sampled", logs.output[0])
+
+    def test_endpoint(self):
+        self.get(1)
+        response = self.client.get(reverse('chess:metrics'))
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertContains(
+            response, 'chs_request_duration_seconds_bucket{'
+                      'view="chess:mainpage",le="+Inf"}')
+        response = self.client.get(
+            reverse('chess:metrics'), REMOTE_ADDR="192.0.2.1")
+        self.assertEqual(response.status_code, 404)
+
+
+# Games with promotions to every piece, and random games.
+PROMOTIONS = "e2e4 d7d5 e4d5 c7c6 d5c6 g8f6 c6b7 b8d7".split()
+
+
+def sample_games(count=20, plies=120):
+    games = [
+        [chess.Move.from_uci(m) for m in PROMOTIONS + ["b7a8" + piece]]
+        for piece in "qrbn"
+    ]
+    rand = random.Random(0)
+    for _ in range(count):
+        board = chess.Board()
+        for _ in range(plies):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rand.choice(moves))
+        games.append(board.move_stack)
+    return games
+
+
+class CodecTest(SimpleTestCase):
+    """Move encodings, and the batch codec against the per game functions."""
+
+    def test_round_trip(self):
+        for encoding in (pgn.WIDE, pgn.COMPACT):
+            for moves in sample_games():
+                data = pgn.encode_move_list(moves, encoding)
+                self.assertEqual(
+                    len(data), len(moves) * pgn.move_size(encoding))
+                self.assertEqual(pgn.decode_moves(data, encoding), moves)
+
+    def test_batch(self):
+        games = sample_games()
+        for encoding in (pgn.WIDE, pgn.COMPACT):
+            with self.settings(CHS_MOVE_ENCODING=encoding):
+                data = codec.encode_batch(games)
+                self.assertEqual(
+                    data, [pgn.encode_move_list(moves) for moves in games])
+                self.assertEqual(codec.decode_batch(data), games)
+
+
+class ReplayTest(SimpleTestCase):
+    """San moves and positions of detail pages, replayed once."""
+
+    def setUp(self):
+        pgn.replay_moves.cache_clear()
+
+    def test_replay(self):
+        for moves in sample_games(count=5):
+            data = pgn.encode_move_list(moves)
+            game = models.Game(moves=data)
+            self.assertEqual(list(game.moves_san()), pgn.san_moves(moves))
+            board = chess.Board()
+            fens = [board.fen()]
+            for move in moves:
+                board.push(move)
+                fens.append(board.fen())
+            self.assertEqual(list(game.moves_fen()), fens)
+
+    def test_cached(self):
+        data = pgn.encode_move_list(sample_games(count=1)[-1])
+        game = models.Game(moves=data)
+        game.moves_san()
+        game.moves_fen()
+        models.Opening(moves=data).moves_san()
+        info = pgn.replay_moves.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 2))
+
+
+READER_PGN = """[Event "Open"]
+[Site "Paris"]
+[Date "2001.05.??"]
+[Round "3"]
+[White "Doe, John"]
+[Black "Roe, Jane"]
+[Result "1/2-1/2"]
+[WhiteElo "2250"]
+[EventDate "2001.05.01"]
+
+1. e4 {King pawn} e5 (1... c5 2. Nf3 (2. c3) d6) 2. Nf3 $1 Nc6
+(2... d6 3. d4) 3. Bb5 a6 $6 4. Ba4 Nf6 1/2-1/2
+
+[Event "?"]
+[Site "?"]
+[Date "????.??.??"]
+[White "Smith"]
+[Black "?"]
+[Result "*"]
+
+1. d4 d5 2. c4 (2. Nf3 Nf6) dxc4 *
+
+"""
+
+
+class ReaderTest(SimpleTestCase):
+    """The lean record reader against records of full game trees."""
+
+    def test_same_records(self):
+        for encoding in (pgn.WIDE, pgn.COMPACT):
+            with self.settings(CHS_MOVE_ENCODING=encoding):
+                lean = StringIO(READER_PGN)
+                full = StringIO(READER_PGN)
+                count = 0
+                while True:
+                    record = pgn.read_record(lean)
+                    game = chess.pgn.read_game(full)
+                    if game is None:
+                        self.assertIsNone(record)
+                        break
+                    self.assertEqual(record, pgn.game_record(
+                        game.headers, pgn.encode_moves(game)))
+                    count += 1
+                self.assertEqual(count, 2)
+
+
+class OpeningTrieTest(SimpleTestCase):
+
+    def test_classify(self):
+        openings = [
+            (1, ["e2e4"]),
+            (2, ["e2e4", "e7e5"]),
+            (3, ["e2e4", "e7e5", "g1f3", "b8c6", "f1b5"]),
+            (4, ["d2d4"]),
+            (5, PROMOTIONS),
+        ]
+        for encoding in (pgn.WIDE, pgn.COMPACT):
+            with self.settings(CHS_MOVE_ENCODING=encoding):
+                encoded = [
+                    (pk, pgn.encode_moves_from_uci(moves))
+                    for pk, moves in openings
+                ]
+                trie = models.OpeningTrie(encoded)
+                games = [pgn.encode_moves_from_uci(moves)
+                         for pk, moves in openings]
+                games += [pgn.encode_move_list(moves)
+                          for moves in sample_games()]
+                for moves in games:
+                    prefixes = [(len(m), pk) for pk, m in encoded
+                                if moves.startswith(m)]
+                    expected = max(prefixes)[1] if prefixes else None
+                    self.assertEqual(trie.classify(moves), expected)
+
+
+class OpeningTreeTest(TestCase):
+    """Parents and paths of the materialized opening tree."""
+
+    @classmethod
+    def setUpTestData(cls):
+        account = create_account("owner", "secret")
+        # Created children first, the tree is built afterwards.
+        cls.knight = create_opening(
+            account, ["e2e4", "e7e5", "g1f3"], "King's Knight")
+        cls.open = create_opening(account, ["e2e4", "e7e5"], "Open Game")
+        cls.king = create_opening(account, ["e2e4"], "King's Pawn")
+        cls.queen = create_opening(account, ["d2d4"], "Queen's Pawn")
+
+    def check_tree(self):
+        openings = models.Opening.objects.in_bulk()
+        king = openings[self.king.pk]
+        knight = openings[self.knight.pk]
+        self.assertIsNone(king.parent_id)
+        self.assertEqual(openings[self.open.pk].parent_id, self.king.pk)
+        self.assertEqual(knight.parent_id, self.open.pk)
+        self.assertIsNone(openings[self.queen.pk].parent_id)
+        self.assertEqual(knight.ancestor_ids(),
+                         [self.king.pk, self.open.pk, self.knight.pk])
+        self.assertEqual(list(king.variations()),
+                         [openings[self.open.pk], knight])
+        self.assertEqual(list(knight.variation_of()),
+                         [king, openings[self.open.pk]])
+        self.assertEqual(list(openings[self.queen.pk].variations()), [])
+
+    def test_rebuild(self):
+        moved = models.rebuild_opening_tree()
+        self.assertEqual(moved, {self.king.pk, self.open.pk, self.knight.pk,
+                                 self.queen.pk})
+        self.check_tree()
+        self.assertEqual(models.rebuild_opening_tree(), set())
+
+    def test_after_migrate(self):
+        schema.create_schema(using='default')
+        self.check_tree()
+
+
+class SchemaTest(TestCase):
+    """Objects created after migrations, with or without pg_trgm."""
+
+    def indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes")
+            return {name for name, in cursor.fetchall()}
+
+    def test_without_trigram(self):
+        with mock.patch.object(schema, 'create_trigram_extension',
+                               return_value=False), \
+                self.assertLogs('chs.schema', 'WARNING'):
+            schema.create_schema(using='default')
+        indexes = self.indexes()
+        self.assertIn('chs_gameside_upper_lastname', indexes)
+        self.assertFalse([name for name in indexes
+                          if name.endswith('_trgm')])
+        # Substring search still works, without the indexes.
+        pgn.load_string(REMATCH_PGN, create_account("owner", "secret"))
+        players = models.Player.objects.filter(lastname__chs_icontains="ARL")
+        self.assertEqual([p.lastname for p in players], ["Carlsen"])
+
+    def test_trigram_extension(self):
+        cursor = mock.Mock()
+        cursor.fetchone.side_effect = [(1,)]
+        self.assertTrue(schema.create_trigram_extension(cursor))
+        self.assertEqual(cursor.execute.call_count, 1)
+
+        cursor = mock.Mock()
+        cursor.fetchone.side_effect = [None, None]
+        self.assertFalse(schema.create_trigram_extension(cursor))
+        self.assertEqual(cursor.execute.call_count, 2)
+
+        cursor = mock.Mock()
+        cursor.fetchone.side_effect = [None, (1,)]
+        self.assertTrue(schema.create_trigram_extension(cursor))
+        cursor.execute.assert_called_with("CREATE EXTENSION pg_trgm")
+
+
+def load_fixture(owner):
+    dates = ["{}.01.01".format(1990 + i % 7) for i in range(30)]
+    # Games without a date sort last.
+    dates += ["????.??.??"] * 10
+    pgn.load_string("".join(
+        GAME_PGN.format(event=i % 3, date=date, i=i)
+        for i, date in enumerate(dates)
+    ), owner)
+
+
+class FixtureTest(TestCase):
+    """Base of the tests using games stored in the database."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = create_account("owner", "secret")
+        load_fixture(cls.account)
+
+
+class PageCacheTest(FixtureTest):
+    """Detail pages cached until the version of their object changes."""
+
+    def setUp(self):
+        caches['default'].clear()
+        login(self.client, self.account)
+        self.game = models.Game.objects.order_by('pk').first()
+
+    def page(self, name, obj):
+        return self.client.get(
+            reverse('chess:' + name, args=(obj.pk,))).content.decode()
+
+    def test_cached_until_bumped(self):
+        event = self.game.event
+        self.assertIn(event.event_name, self.page('event', event))
+        models.Event.objects.filter(pk=event.pk).update(event_name="Hidden")
+        # The title is outside of the cached fragment.
+        self.assertNotIn("<h1>Hidden</h1>", self.page('event', event))
+        models.bump_versions([event.object_id])
+        self.assertIn("<h1>Hidden</h1>", self.page('event', event))
+
+    def test_player_edit(self):
+        player = self.game.black
+        self.assertIn(player.lastname, self.page('game', self.game))
+        self.client.post(reverse('chess:player_add'), {
+            'id': player.pk, 'firstname': "Boris", 'lastname': "Renamed",
+            'elo': "2300", 'nationality': "",
+        })
+        self.assertIn("Renamed", self.page('game', self.game))
+
+    def test_reclassify(self):
+        lonely = models.find_or_add_player("Lonely", "Player", self.account)
+        create_opening(self.account, ["e2e4", "e7e5"], "Open Game")
+        self.assertNotIn("Open Game", self.page('game', self.game))
+        call_command('reclassify_games', stdout=StringIO())
+        self.assertIn("Open Game", self.page('game', self.game))
+        # Only the pages showing reclassified games are invalidated.
+        lonely.object.refresh_from_db()
+        self.assertEqual(lonely.object.version, 0)
+
+
+class AccountTest(FixtureTest):
+    """The session account and its edit rights, loaded once per request."""
+
+    def setUp(self):
+        self.game = models.Game.objects.select_related('object').order_by(
+            'pk').first()
+        self.stranger = create_account("stranger", "secret")
+        self.granted = create_account("granted", "secret")
+        self.granted.can_edit.add(self.game.object)
+
+    def session_account(self, account):
+        return models.session_account({'account': account.pk})
+
+    def test_edit_rights(self):
+        with self.assertNumQueries(3):
+            owner = self.session_account(self.account)
+            stranger = self.session_account(self.stranger)
+            granted = self.session_account(self.granted)
+        with self.assertNumQueries(0):
+            self.assertTrue(owner.has_edit_rights(self.game))
+            self.assertFalse(stranger.has_edit_rights(self.game))
+            self.assertTrue(granted.has_edit_rights(self.game))
+        self.assertEqual(granted.editable_ids(), {self.game.object_id})
+        self.assertEqual(stranger.editable_ids(), set())
+        self.assertIsNone(models.session_account({}))
+
+    def test_anonymous(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('chess:game', args=(self.game.pk,)))
+        self.assertFalse([q for q in queries.captured_queries
+                          if q['sql'].startswith('SELECT "chs_account"')])
+
+    def test_delete(self):
+        url = reverse('chess:game_delete', args=(self.game.pk,))
+        login(self.client, self.stranger)
+        response = self.client.get(url)
+        self.assertContains(response, "you can not delete this object")
+        self.assertTrue(
+            models.Game.objects.filter(pk=self.game.pk).exists())
+        login(self.client, self.granted)
+        self.client.get(url)
+        self.assertFalse(
+            models.Game.objects.filter(pk=self.game.pk).exists())
+
+
+class CommandTest(TransactionTestCase):
+    """Base of the tests running management commands on the fixture games.
+
+    Commands rebuilding a table truncate it, which Postgres refuses in the
+    transaction of a `TestCase` once it has deferred constraint checks.
+    """
+
+    def setUp(self):
+        self.account = create_account("owner", "secret")
+        load_fixture(self.account)
+
+
+class LookupCacheTest(TestCase):
+    """Player and event lookups through the import cache."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = create_account("owner", "secret")
+        cls.anna = models.find_or_add_player("Anna", "White", cls.account)
+        cls.boris = models.find_or_add_player("Boris", "Black", cls.account)
+
+    def test_lru(self):
+        cache = models.LookupCache(2)
+        cache.fill([("a", 1), ("b", 2)])
+        self.assertTrue(cache.complete)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        # "b" was the least recently used.
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertFalse(cache.complete)
+
+        cache = models.LookupCache(1)
+        cache.fill([("a", 1), ("b", 2)])
+        self.assertFalse(cache.complete)
+
+    def test_complete_cache(self):
+        cache = models.ImportCache()
+        cache.warm()
+        self.assertTrue(cache.players.complete)
+        # Known players are found, and unknown ones known to be missing,
+        # without looking them up.
+        with self.assertNumQueries(0):
+            players = models.find_or_add_players(
+                [("Anna", "White", 2400), ("Boris", "Black", None)],
+                self.account, cache)
+        self.assertEqual(players, {("Anna", "White"): self.anna.pk,
+                                   ("Boris", "Black"): self.boris.pk})
+        players = models.find_or_add_players(
+            [("Carl", "New", 2000), ("Anna", "White", None)],
+            self.account, cache)
+        self.assertEqual(players[("Anna", "White")], self.anna.pk)
+        self.assertEqual(cache.players.get(("Carl", "New")),
+                         players[("Carl", "New")])
+        self.assertEqual(models.Player.objects.count(), 3)
+
+    def test_partial_cache(self):
+        cache = models.ImportCache(1)
+        cache.warm()
+        self.assertFalse(cache.players.complete)
+        players = models.find_or_add_players(
+            [("Boris", "Black", None)], self.account, cache)
+        self.assertEqual(players, {("Boris", "Black"): self.boris.pk})
+        self.assertEqual(models.Player.objects.count(), 2)
+
+    def test_events(self):
+        cache = models.ImportCache()
+        events = models.find_or_add_events(
+            [("Open", None), ("Open", "2000-01-01")], self.account, cache)
+        with self.assertNumQueries(0):
+            self.assertEqual(models.find_or_add_events(
+                [("Open", None)], self.account, cache), events)
+        self.assertEqual(models.Event.objects.get().event_name, "Open")
+
+
+# Two players meeting twice, with another elo rating in the second game.
+REMATCH_PGN = """[Event "Match"]
+[White "Carlsen, Magnus"]
+[Black "Kasparov, Garry"]
+[Result "1-0"]
+[WhiteElo "2800"]
+[BlackElo "2700"]
+
+1. e4 e5 1-0
+
+[Event "Match"]
+[White "Kasparov, Garry"]
+[Black "Carlsen, Magnus"]
+[Result "0-1"]
+[WhiteElo "2750"]
+[BlackElo "2820"]
+
+1. d4 d5 0-1
+
+"""
+
+
+def stored_games():
+    """Players, games and positions in the database, without primary keys."""
+    players = sorted(models.Player.objects.values_list(
+        'firstname', 'lastname', 'elo_rating'))
+    games = sorted(
+        (bytes(game[0]),) + game[1:]
+        for game in models.Game.objects.values_list(
+            'moves', 'white__lastname', 'black__lastname',
+            'event__event_name', 'result', 'start_date'))
+    positions = sorted(
+        (bytes(moves), ply, zobrist)
+        for moves, ply, zobrist in models.Position.objects.values_list(
+            'game__moves', 'ply', 'zobrist'))
+    return players, games, positions
+
+
+def load_and_rollback(text, owner, batch_size):
+    """`stored_games` after loading a pgn string, which is then undone."""
+    with transaction.atomic():
+        pgn.load_file(StringIO(text), owner, batch_size=batch_size,
+                      resume=False)
+        res = stored_games()
+        transaction.set_rollback(True)
+    return res
+
+
+class LoadTest(TestCase):
+    """Games loaded by batches against games loaded one by one."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = create_account("owner", "secret")
+
+    def load(self, text, batch_size):
+        return load_and_rollback(text, self.account, batch_size)
+
+    def test_elo_of_first_game(self):
+        players, games, positions = self.load(REMATCH_PGN, 10)
+        self.assertEqual(players, [
+            ("Garry", "Kasparov", 2700), ("Magnus", "Carlsen", 2800)])
+        self.assertEqual(len(games), 2)
+
+    def test_same_as_unbatched(self):
+        text = REMATCH_PGN + "".join(
+            GAME_PGN.format(event=i % 3, date="2000.01.01", i=i)
+            for i in range(10))
+        expected = self.load(text, None)
+        for batch_size in (1, 3, 100):
+            self.assertEqual(self.load(text, batch_size), expected)
+
+
+class GameSideTest(TransactionTestCase):
+    """Game search by player, through the game side table."""
+
+    def setUp(self):
+        self.account = create_account("owner", "secret")
+        pgn.load_string(REMATCH_PGN, self.account)
+
+    def search(self, **query):
+        return sorted(views.filter_games(query).values_list(
+            'white__lastname', 'black__lastname'))
+
+    def sides(self):
+        return sorted(models.GameSide.objects.values_list(
+            'game_id', 'white', 'player_id', 'lastname', 'elo_rating',
+            'result'))
+
+    def test_same_side(self):
+        both = [("Carlsen", "Kasparov"), ("Kasparov", "Carlsen")]
+        self.assertEqual(self.search(player="carlsen"), both)
+        self.assertEqual(
+            self.search(player="Carlsen", player_elo_min=2750), both)
+        # Carlsen is above 2750 in both games, not Kasparov.
+        self.assertEqual(
+            self.search(player="Kasparov", player_elo_min=2750), [])
+
+    def test_player_edit(self):
+        player = models.Player.objects.get(lastname="Kasparov")
+        login(self.client, self.account)
+        self.client.post(reverse('chess:player_add'), {
+            'id': player.pk, 'firstname': "Garry", 'lastname': "Renamed",
+            'elo': "2900", 'nationality': "RUS",
+        })
+        self.assertEqual(
+            len(self.search(player="Renamed", player_elo_min=2850)), 2)
+        self.assertEqual(self.search(player="Kasparov"), [])
+
+    def test_rebuild(self):
+        expected = self.sides()
+        self.assertEqual(len(expected), 4)
+        out = StringIO()
+        call_command('rebuild_game_sides', stdout=out)
+        self.assertEqual(self.sides(), expected)
+        self.assertEqual(out.getvalue().strip(), "Stored 4 game sides")
+
+
+class ExportTest(FixtureTest):
+    """Pgn export of the games of a search."""
+
+    def export(self, **query):
+        response = self.client.get(reverse('chess:game_export'), query)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], "application/x-chess-pgn")
+        return b"".join(response.streaming_content).decode()
+
+    def test_filtered(self):
+        text = self.export(black="Black1")
+        # Black1 and Black10 to Black19.
+        self.assertEqual(text.count("[Event "), 11)
+        dates = re.findall(r'\[Date "(.*)"\]', text)
+        self.assertEqual(dates, sorted(dates))
+
+    def test_undated_last(self):
+        dates = re.findall(r'\[Date "(.*)"\]', self.export())
+        self.assertEqual(dates[30:], ["????.??.??"] * 10)
+        self.assertEqual(dates[:30], sorted(dates[:30]))
+
+    def test_round_trip(self):
+        text = self.export()
+        expected = stored_games()[1]
+        with transaction.atomic():
+            models.Game.objects.all().delete()
+            pgn.load_string(text, self.account)
+            self.assertEqual(stored_games()[1], expected)
+            transaction.set_rollback(True)
+
+
+class ParallelTest(TransactionTestCase):
+    """Games parsed by worker processes against the sequential reader.
+
+    The reader closes the database connections before starting the
+    workers, which a `TestCase` transaction would not survive.
+    """
+
+    def setUp(self):
+        self.account = create_account("owner", "secret")
+        self.text = REMATCH_PGN + "".join(
+            GAME_PGN.format(event=i % 3, date="2000.01.01", i=i)
+            for i in range(10))
+        with tempfile.NamedTemporaryFile(
+                'w', suffix=".pgn", delete=False) as file:
+            file.write(self.text)
+        self.path = file.name
+        self.addCleanup(os.remove, self.path)
+
+    def test_split_games(self):
+        data = self.text.encode()
+        chunks = list(pgn.split_games(BytesIO(data), 5))
+        self.assertEqual([len(pgn.parse_chunk(chunk, "utf-8"))
+                          for chunk, end in chunks], [5, 5, 2])
+        self.assertEqual(b"".join(chunk for chunk, end in chunks), data)
+        for chunk, end in chunks:
+            self.assertTrue(data[:end].endswith(chunk))
+
+    def test_same_records(self):
+        with open(self.path) as file:
+            expected = [records for records, end in pgn.read_chunks(file, 5)]
+        chunks = list(pgn.read_chunks_parallel(self.path, "utf-8", 2, 5))
+        self.assertEqual([records for records, end in chunks], expected)
+        self.assertEqual(chunks[-1][1], os.path.getsize(self.path))
+
+    def test_load(self):
+        expected = load_and_rollback(self.text, self.account, 5)
+        count = pgn.load_file_parallel(
+            self.path, self.account, processes=2, batch_size=5)
+        self.assertEqual(count, 12)
+        self.assertEqual(stored_games(), expected)
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+
+
+class ImportTest(TransactionTestCase):
+    """The COPY based import command against the batch loader."""
+
+    def setUp(self):
+        self.account = create_account("owner", "secret")
+        self.text = REMATCH_PGN + "".join(
+            GAME_PGN.format(event=i % 3, date="2000.01.01", i=i)
+            for i in range(10))
+        with tempfile.NamedTemporaryFile(
+                'w', suffix=".pgn", delete=False) as file:
+            file.write(self.text)
+        self.path = file.name
+        self.addCleanup(os.remove, self.path)
+
+    def import_pgn(self, *args):
+        out = StringIO()
+        call_command('import_pgn', self.path, "--owner=owner", *args,
+                     stdout=out)
+        return out.getvalue()
+
+    def test_same_as_load_file(self):
+        expected = load_and_rollback(self.text, self.account, 100)
+        out = self.import_pgn()
+        self.assertIn("Loaded 12 games", out)
+        self.assertEqual(stored_games(), expected)
+        self.assertEqual(len(expected[1]), 12)
+
+        # Games are only imported once.
+        self.import_pgn("--restart")
+        self.assertEqual(stored_games(), expected)
+
+
+MOVES_PGN = """[Event "Blitz"]
+[White "White, Anna"]
+[Black "Black, Boris"]
+[Result "*"]
+
+{}
+
+"""
+
+# Games as uci moves, the first two reach the same position.
+TRANSPOSITIONS = [
+    "e2e4 e7e5 g1f3 b8c6",
+    "g1f3 b8c6 e2e4 e7e5",
+    "e2e4 e7e5 b1c3 b8c6",
+]
+
+
+class PositionTest(TestCase):
+    """Search of the games reaching a position, whatever the move order."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = create_account("owner", "secret")
+        pgn.load_string("".join(
+            MOVES_PGN.format(pgn.pgn_movetext(pgn.san_moves(
+                chess.Move.from_uci(move) for move in moves.split()), "*"))
+            for moves in TRANSPOSITIONS
+        ), cls.account)
+
+    def reaching(self, position):
+        games = models.games_reaching(pgn.parse_position(position))
+        return set(bytes(m) for m in games.values_list('moves', flat=True))
+
+    def test_transpositions(self):
+        games = [pgn.encode_moves_from_uci(m.split()) for m in TRANSPOSITIONS]
+        self.assertEqual(self.reaching("g1f3,b8c6,e2e4,e7e5"), set(games[:2]))
+        self.assertEqual(self.reaching("e2e4,e7e5"), {games[0], games[2]})
+        self.assertEqual(self.reaching("d2d4"), set())
+
+        response = self.client.get(reverse('chess:game_list'), {
+            'position': chess.Board().fen()})
+        self.assertEqual(len(response.context['game_list']), 3)
+        response = self.client.get(reverse('chess:game_list'), {
+            'moves': "g1f3,b8c6,e2e4,e7e5", 'transpositions': "on"})
+        self.assertEqual(len(response.context['game_list']), 2)
+
+    def test_index_command(self):
+        expected = stored_games()
+        self.assertEqual(len(expected[2]), 12)
+        call_command('index_positions', rebuild=True, stdout=StringIO())
+        self.assertEqual(stored_games(), expected)
+
+        models.Position.objects.filter(ply__gt=2).delete()
+        out = StringIO()
+        call_command('index_positions', stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Indexed 0 games")
+        models.Position.objects.all().delete()
+        call_command('index_positions', stdout=out)
+        self.assertEqual(stored_games(), expected)
+
+
+class GameStatisticsTest(TransactionTestCase):
+    """Cached statistics of the game list, after changes to the games."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.account = create_account("owner", "secret")
+        pgn.load_string(REMATCH_PGN, self.account)
+
+    def game_number(self, **query):
+        response = self.client.get(reverse('chess:game_list'), query)
+        return response.context['game_number']
+
+    def test_generation_changes_on_commit(self):
+        generation = models.games_generation()
+        with transaction.atomic():
+            models.games_changed()
+            self.assertEqual(models.games_generation(), generation)
+            transaction.set_rollback(True)
+        self.assertEqual(models.games_generation(), generation)
+
+        with transaction.atomic():
+            models.games_changed()
+        self.assertNotEqual(models.games_generation(), generation)
+        # Seen by the other processes.
+        self.assertEqual(caches['shared'].get(models.GAMES_GENERATION_KEY),
+                         models.games_generation())
+
+    def test_statistics_invalidated(self):
+        self.assertEqual(self.game_number(), 2)
+        self.assertEqual(self.game_number(white="Carlsen"), 1)
+
+        pgn.load_string(GAME_PGN.format(event=0, date="2000.01.01", i=0),
+                        self.account)
+        self.assertEqual(self.game_number(), 3)
+
+        login(self.client, self.account)
+        player = models.Player.objects.get(lastname="Carlsen")
+        self.client.post(reverse('chess:player_add'), {
+            'id': player.pk, 'firstname': "Magnus", 'lastname': "Renamed",
+            'elo': "2800", 'nationality': "NOR",
+        })
+        self.assertEqual(self.game_number(white="Carlsen"), 0)
+        self.assertEqual(self.game_number(white="Renamed"), 1)
+
+
+class CheckpointTest(TestCase):
+    """Imports resuming from the position saved by an interrupted one."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = create_account("owner", "secret")
+
+    def setUp(self):
+        self.games = [GAME_PGN.format(event=0, date="2000.01.01", i=i)
+                      for i in range(6)]
+        with tempfile.NamedTemporaryFile(
+                'w', suffix=".pgn", delete=False) as file:
+            file.write("".join(self.games))
+        self.path = file.name
+        self.addCleanup(os.remove, self.path)
+        # As if an import stopped after the first two games.
+        models.save_checkpoint(self.path, len("".join(self.games[:2])))
+
+    def load(self):
+        with open(self.path) as file:
+            return pgn.load_file(file, self.account, batch_size=2)
+
+    def test_resume(self):
+        self.assertEqual(self.load(), 4)
+        names = models.Game.objects.values_list('black__lastname', flat=True)
+        self.assertEqual(sorted(names),
+                         ["Black{}".format(i) for i in range(2, 6)])
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+
+    def test_file_changed(self):
+        with open(self.path, 'a') as file:
+            file.write(GAME_PGN.format(event=0, date="2000.01.01", i=6))
+        self.assertEqual(models.checkpoint_offset(self.path), 0)
+        self.assertEqual(self.load(), 7)
+
+    def test_file_replaced(self):
+        with open(self.path, 'w') as file:
+            file.write("".join(reversed(self.games)))
+        # Same size, modified later.
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(models.checkpoint_offset(self.path), 0)
+        self.assertEqual(self.load(), 6)
+
+
+class KeysetTest(FixtureTest):
+
+    def ordered(self):
+        games = models.Game.objects.order_by('pk')
+        return [g.pk for g in sorted(
+            games, key=lambda g: (g.start_date is None, g.start_date, g.pk))]
+
+    def test_cursor_round_trip(self):
+        for game in models.Game.objects.all():
+            key = views.cursor_key(game, 'start_date')
+            self.assertEqual(
+                views.parse_cursor(models.Game, 'start_date', key),
+                (game.start_date, game.pk))
+
+    def test_seek(self):
+        queryset = models.Game.objects.all()
+        expected = self.ordered()
+        for count in (1, 7, 30, 50):
+            # Forward through all pages.
+            pages = []
+            key = None
+            while True:
+                page = views.seek(queryset, 'start_date', key, True, count)
+                if not page:
+                    break
+                pages.extend(g.pk for g in page)
+                key = views.parse_cursor(
+                    models.Game, 'start_date',
+                    views.cursor_key(page[-1], 'start_date'))
+            self.assertEqual(pages, expected)
+
+            # Backward from the last game.
+            last = models.Game.objects.get(pk=expected[-1])
+            pages = [last.pk]
+            key = views.parse_cursor(
+                models.Game, 'start_date',
+                views.cursor_key(last, 'start_date'))
+            while True:
+                page = views.seek(queryset, 'start_date', key, False, count)
+                if not page:
+                    break
+                pages[:0] = [g.pk for g in page]
+                key = views.parse_cursor(
+                    models.Game, 'start_date',
+                    views.cursor_key(page[0], 'start_date'))
+            self.assertEqual(pages, expected)
+
+
+class KeysetPageTest(FixtureTest):
+    """Page links of the game list, by page number or from a cursor."""
+
+    def get(self, **query):
+        with mock.patch.object(views.GameList, 'paginate_by', 7):
+            return self.client.get(reverse('chess:game_list'), query)
+
+    def test_page_links(self):
+        response = self.get()
+        self.assertEqual(response.context['page_links'], [1, 2, 3, 4, 5, 6])
+        self.assertContains(response, 'class="current_page">1<', count=2)
+        next_cursor = response.context['next_cursor']
+        self.assertTrue(next_cursor)
+        self.assertFalse(response.context['previous_cursor'])
+
+        response = self.get(after_key=next_cursor)
+        self.assertEqual(response.context['page_links'], [])
+        self.assertNotRegex(response.content.decode(), r"page=\d")
+        self.assertNotContains(response, "current_page")
+        self.assertTrue(response.context['previous_cursor'])
+        self.assertTrue(response.context['next_cursor'])
+
+        response = self.get(page=3)
+        self.assertEqual(response.context['page_links'], [1, 2, 3, 4, 5, 6])
+        self.assertContains(response, 'class="current_page">3<', count=2)
+
+
+class ExplorerTest(CommandTest):
+    """Opening explorer statistics, kept up to date and rebuilt."""
+
+    def setUp(self):
+        super(ExplorerTest, self).setUp()
+        pgn.load_string(REMATCH_PGN, self.account)
+
+    def explore(self, moves):
+        response = self.client.get(reverse('chess:explorer'),
+                                   {'moves': moves})
+        return response.json()['moves']
+
+    def move_stats(self):
+        return sorted(
+            (bytes(prefix), bytes(move)) + tuple(rest)
+            for prefix, move, *rest in models.MoveStat.objects.filter(
+                games__gt=0).values_list(
+                'prefix', 'move', 'games', 'white', 'draws', 'black'))
+
+    def test_endpoint(self):
+        self.assertEqual(self.explore(""), [
+            {'uci': "e2e4", 'san': "e4", 'games': 41,
+             'white': 100, 'draws': 0, 'black': 0},
+            {'uci': "d2d4", 'san': "d4", 'games': 1,
+             'white': 0, 'draws': 0, 'black': 100},
+        ])
+        self.assertEqual(
+            [m['san'] for m in self.explore("e2e4,e7e5")], ["Nf3"])
+        self.assertEqual(self.explore("d2d4,d7d5"), [])
+        response = self.client.get(reverse('chess:explorer'),
+                                   {'moves': "e2e5"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_beyond_depth(self):
+        expected = self.explore("e2e4,e7e5,g1f3")
+        with self.settings(CHS_EXPLORER_DEPTH=2):
+            self.assertEqual(self.explore("e2e4,e7e5,g1f3"), expected)
+
+    def test_rebuild(self):
+        login(self.client, self.account)
+        game = models.Game.objects.filter(result="0-1").get()
+        self.client.get(reverse('chess:game_delete', args=(game.pk,)))
+        self.assertEqual([m['uci'] for m in self.explore("")], ["e2e4"])
+
+        expected = self.move_stats()
+        out = StringIO()
+        call_command('rebuild_explorer', stdout=out)
+        self.assertEqual(self.move_stats(), expected)
+        self.assertEqual(out.getvalue().strip(),
+                         "Stored statistics for 6 moves")
+
+    def test_reencode(self):
+        expected = self.explore("e2e4")
+        with self.settings(CHS_MOVE_ENCODING=pgn.COMPACT):
+            call_command('reencode_moves', '--from=wide', '--to=compact',
+                         stdout=StringIO())
+            self.assertEqual(self.explore("e2e4"), expected)
+            self.assertEqual(len(self.move_stats()[0][1]), 1)
+
+
+class ObjectRedirectTest(CommandTest):
+    """Object urls, redirected by the kind stored on the object."""
+
+    def setUp(self):
+        super(ObjectRedirectTest, self).setUp()
+        game = models.Game.objects.order_by('pk').first()
+        opening = create_opening(self.account, ["e2e4"], "King's Pawn")
+        self.objects = [('game', game), ('player', game.white),
+                        ('event', game.event), ('opening', opening)]
+
+    def test_redirect(self):
+        for name, obj in self.objects:
+            with self.assertNumQueries(1):
+                response = self.client.get(
+                    reverse('chess:object', args=(obj.pk,)))
+            self.assertRedirects(
+                response, reverse('chess:' + name, args=(obj.pk,)))
+
+    def test_not_found(self):
+        obj = models.create_obj(self.account, "")
+        for pk in (obj.pk, obj.pk + 1):
+            response = self.client.get(reverse('chess:object', args=(pk,)))
+            self.assertEqual(response.status_code, 404)
+
+    def test_backfill(self):
+        models.Object.objects.update(kind="")
+        schema.create_schema(using='default')
+        for name, obj in self.objects:
+            obj.object.refresh_from_db()
+            self.assertEqual(obj.object.kind, name)
+
+
+class SnapshotTest(CommandTest):
+    """Columnar snapshots against the games they were exported from."""
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        pgn.load_string(REMATCH_PGN, self.account)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        out = StringIO()
+        call_command('export_snapshot', directory.name, stdout=out)
+        self.assertTrue(out.getvalue().startswith("Wrote 42 games"))
+        self.snapshot = snapshot.Snapshot(directory.name)
+
+    def test_round_trip(self):
+        games = models.Game.objects.order_by('object_id').select_related(
+            'white', 'black')
+        self.assertEqual(len(self.snapshot), len(games))
+        for i, game in enumerate(games):
+            self.assertEqual(self.snapshot.ids[i], game.object_id)
+            self.assertEqual(self.snapshot.white_elo[i],
+                             game.white.elo_rating)
+            self.assertEqual(self.snapshot.black[i], game.black_id)
+            self.assertEqual(self.snapshot.events[i],
+                             game.event_id or -1)
+            self.assertEqual(
+                self.snapshot.results[i], snapshot.RESULT_CODES[game.result])
+            if game.start_date is None:
+                self.assertTrue(np.isnat(self.snapshot.dates[i]))
+            else:
+                self.assertEqual(self.snapshot.dates[i].astype(object),
+                                 game.start_date)
+            self.assertEqual(self.snapshot.game_moves(i),
+                             pgn.decode_moves(game.moves))
+
+    def test_results_by_elo(self):
+        bands, counts = snapshot.results_by_elo(self.snapshot)
+        self.assertEqual(bands.tolist(), [2300, 2400, 2500, 2600, 2700])
+        # The fixture at 2350 average, the rematch at 2750.
+        self.assertEqual(counts.tolist(), [
+            [40, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0],
+            [1, 0, 1, 0]])
+
+
+class ResultStatTest(CommandTest):
+    """Counters kept up to date by the views against recomputed ones."""
+
+    def check_counters(self):
+        out = StringIO()
+        call_command('rebuild_stats', check=True, stdout=out)
+        self.assertEqual(out.getvalue().strip(), "0 counters differ")
+
+    def test_counters(self):
+        self.check_counters()
+        self.assertTrue(models.ResultStat.objects.exists())
+
+        login(self.client, self.account)
+        games = models.Game.objects.order_by('pk')
+        self.client.post(reverse('chess:game_add'), {
+            'id': games[0].pk, 'moves': "d2d4,d7d5", 'result': "0-1",
+            'event': "Tournament 5", 'white_first': "Anna",
+            'white_last': "White", 'black_first': "", 'black_last': "New",
+        })
+        self.client.get(reverse('chess:game_delete', args=(games[1].pk,)))
+        self.check_counters()
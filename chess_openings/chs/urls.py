@@ -13,6 +13,7 @@ urlpatterns = [
         views.GameList.as_view(),
         name='game_list'),
     url(r'^game/search/$', views.search_game, name='game_search'),
+    url(r'^game/export/$', views.export_games, name='game_export'),
     url(r'^game/create/$', views.create_game, name='game_create'),
     url(r'^game/add/$', views.add_game, name='game_add'),
     url(r'^game/add/pgn/$', views.add_game_pgn, name='game_add_pgn'),
@@ -51,6 +52,8 @@ urlpatterns = [
     url(r'^opening/add/$', views.add_opening, name='opening_add'),
     url(r'^opening/edit/(?P<pk>[0-9]+)/$', views.edit_opening, name='opening_edit'),
     url(r'^opening/delete/(?P<pk>[0-9]+)/$', views.delete_opening, name='opening_delete'),
+    url(r'^explorer/$', views.explore, name='explorer'),
+    url(r'^metrics$', views.export_metrics, name='metrics'),
     url(r'^(?P<pk>[0-9]+)/$',
         views.object,
         name='object'),
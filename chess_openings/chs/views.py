@@ -1,10 +1,20 @@
-from django.http import Http404, HttpResponseRedirect
+from django.http import (
+    Http404, HttpResponse, HttpResponseRedirect, JsonResponse,
+    StreamingHttpResponse)
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
 from django.views import generic
-from django.db.models import Q
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import Case, Count, Q, When
 from django.core.urlresolvers import reverse
 from django.shortcuts import render, get_object_or_404
-from django.db.models.sql.constants import INNER, LOUTER
+from . import explorer
+from . import metrics
 from . import pgn
+from . import stats
 
 from . import models
 
@@ -33,251 +43,388 @@ def pagination_links(current, total):
     return left + middle + right
 
 
+class CountedPaginator(Paginator):
+    """A paginator for an object list of already known length."""
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.count = count
+
+
+def game_statistics(queryset):
+    """Number of games and of each result, in a single query."""
+    return queryset.order_by().aggregate(
+        games=Count('pk'),
+        white=Count(Case(When(result='1-0', then=1))),
+        black=Count(Case(When(result='0-1', then=1))),
+        draws=Count(Case(When(result='1/2-1/2', then=1))),
+    )
+
+
+def estimated_count(queryset):
+    """Number of rows of a queryset, as estimated by the query planner."""
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    return plan[0]['Plan']['Plan Rows']
+
+
+def cursor_key(obj, field):
+    """Position of an object in a list sorted by (field, primary key)."""
+    value = getattr(obj, field)
+    if value is None:
+        return str(obj.pk)
+    return "{}:{}".format(obj.pk, value)
+
+
+def parse_cursor(model, field, cursor):
+    """Inverse of `cursor_key`, returns a (value, primary key) pair."""
+    pk, sep, value = cursor.partition(":")
+    pk = int(pk)
+    if not sep:
+        return None, pk
+    try:
+        return model._meta.get_field(field).to_python(value), pk
+    except ValidationError:
+        raise ValueError("invalid cursor value " + value)
+
+
+def seek(queryset, field, key, forward, count):
+    """Fetch a page of a list sorted by (field, primary key), nulls last.
+
+    Returns up to `count` objects right after (or before, if not `forward`)
+    the position `key` given by `parse_cursor`, or from the start of the
+    list if `key` is None. Non null values are fetched with a row
+    comparison, so that each page is a single index range scan.
+    """
+    model = queryset.model
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    columns = "({0}.{1}, {0}.{2})".format(
+        table,
+        qn(model._meta.get_field(field).column),
+        qn(model._meta.pk.column)
+    )
+    nullable = model._meta.get_field(field).null
+    values = queryset.filter(**{field + '__isnull': False})
+    nulls = queryset.filter(**{field + '__isnull': True})
+
+    if forward:
+        if key is None:
+            parts = [values.order_by(field, 'pk')]
+        elif key[0] is None:
+            parts = [nulls.filter(pk__gt=key[1]).order_by('pk')]
+        else:
+            parts = [values.extra(
+                where=[columns + " > (%s, %s)"], params=list(key)
+            ).order_by(field, 'pk')]
+        if nullable and (key is None or key[0] is not None):
+            parts.append(nulls.order_by('pk'))
+    else:
+        if key[0] is None:
+            parts = [
+                nulls.filter(pk__lt=key[1]).order_by('-pk'),
+                values.order_by('-' + field, '-pk'),
+            ]
+        else:
+            parts = [values.extra(
+                where=[columns + " < (%s, %s)"], params=list(key)
+            ).order_by('-' + field, '-pk')]
+
+    res = []
+    for part in parts:
+        if len(res) >= count:
+            break
+        res.extend(part[:count - len(res)])
+    if not forward:
+        res.reverse()
+    return res
+
+
 class PaginatedListView(generic.ListView):
+    # Field the list is sorted on, with the primary key breaking ties. When
+    # set, pages are fetched from next and previous cursors instead of an
+    # offset, unless a page number is requested.
+    keyset_field = None
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        if self.keyset_field is None:
+            return super(PaginatedListView, self).get_paginator(
+                queryset, per_page, **kwargs)
+        # Only used to jump to a page number, an estimate is good enough.
+        return CountedPaginator(
+            queryset, per_page, estimated_count(queryset), **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        query = self.request.GET
+        field = self.keyset_field
+        if field is None or query.get('page'):
+            paginator, page, objects, is_paginated = super(
+                PaginatedListView, self
+            ).paginate_queryset(queryset, page_size)
+            page.object_list = list(objects)
+            if field is not None and page.object_list:
+                self.cursors = (
+                    page.has_previous() and cursor_key(page.object_list[0], field),
+                    page.has_next() and cursor_key(page.object_list[-1], field),
+                )
+            return paginator, page, page.object_list, is_paginated
+
+        try:
+            if query.get('before_key'):
+                key = parse_cursor(queryset.model, field, query['before_key'])
+                forward = False
+            elif query.get('after_key'):
+                key = parse_cursor(queryset.model, field, query['after_key'])
+                forward = True
+            else:
+                key = None
+                forward = True
+        except ValueError:
+            raise Http404("Invalid page cursor.")
+
+        objects = seek(queryset, field, key, forward, page_size + 1)
+        more = len(objects) > page_size
+        if forward:
+            objects = objects[:page_size]
+            has_previous, has_next = key is not None, more
+        else:
+            objects = objects[-page_size:]
+            has_previous, has_next = more, True
+        if objects:
+            self.cursors = (
+                has_previous and cursor_key(objects[0], field),
+                has_next and cursor_key(objects[-1], field),
+            )
+        paginator = self.get_paginator(queryset, page_size)
+        return paginator, None, objects, True
+
     def get_context_data(self, **kwargs):
         context = super(PaginatedListView, self).get_context_data(**kwargs)
         if context['paginator']:
-            current = context['page_obj'].number
-            total = context['paginator'].num_pages
-            context['page_links'] = pagination_links(current, total)
+            page = context['page_obj']
+            query = self.request.GET
+            if page is None and (query.get('after_key')
+                                 or query.get('before_key')):
+                # The number of a page reached from a cursor is unknown,
+                # only the previous and next links are shown.
+                context['page_links'] = []
+            else:
+                current = page.number if page else 1
+                total = context['paginator'].num_pages
+                context['page_number'] = current
+                context['page_links'] = pagination_links(current, total)
+            previous, next = getattr(self, 'cursors', (None, None))
+            context['previous_cursor'] = previous
+            context['next_cursor'] = next
         return context
 
 
-def can_edit(session, object):
-    return ('account' in session and session['account']
-            and models.has_edit_rights(session['account'], object))
+def can_edit(request, object):
+    return request.account is not None and request.account.has_edit_rights(object)
+
+
+# Relations shown in game tables, fetched with the games.
+GAME_TABLE_RELATED = ('white', 'black', 'event')
+
+
+class CachedDetailView(generic.DetailView):
+    """A detail view whose template caches fragments by object version."""
+    related = ('object',)
+
+    def get_queryset(self):
+        return super(CachedDetailView, self).get_queryset().select_related(
+            *self.related)
+
+    def get_context_data(self, **kwargs):
+        context = super(CachedDetailView, self).get_context_data(**kwargs)
+        context['cache_timeout'] = getattr(
+            settings, 'CHS_PAGE_CACHE_TIMEOUT', 3600)
+        return context
 
 
-class GameDetail(generic.DetailView):
+class GameDetail(CachedDetailView):
     model = models.Game
+    related = CachedDetailView.related + GAME_TABLE_RELATED + ('opening',)
 
     def get_context_data(self, **kwargs):
         context = super(GameDetail, self).get_context_data(**kwargs)
         context['openings'] = context['game'].openings()
-        context['can_edit'] = can_edit(self.request.session, context['game'])
+        context['can_edit'] = can_edit(self.request, context['game'])
         return context
 
 
-class PlayerDetail(generic.DetailView):
+class PlayerDetail(CachedDetailView):
     model = models.Player
 
     def get_context_data(self, **kwargs):
         context = super(PlayerDetail, self).get_context_data(**kwargs)
-        context['player_games'] = context['player'].games()[:50]
-        context['can_edit'] = can_edit(self.request.session, context['player'])
+        player = context['player']
+        context['player_games'] = player.games().select_related(
+            *GAME_TABLE_RELATED)[:50]
+        # Only computed when the page is not cached.
+        context['results'] = SimpleLazyObject(
+            lambda: stats.player_results(player))
+        context['can_edit'] = can_edit(self.request, player)
         return context
 
 
-class EventDetail(generic.DetailView):
+class EventDetail(CachedDetailView):
     model = models.Event
 
     def get_context_data(self, **kwargs):
         context = super(EventDetail, self).get_context_data(**kwargs)
-        context['event_games'] = context['event'].games()[:50]
-        context['can_edit'] = can_edit(self.request.session, context['event'])
+        event = context['event']
+        context['event_games'] = event.games().select_related(
+            *GAME_TABLE_RELATED)[:50]
+        context['results'] = SimpleLazyObject(
+            lambda: stats.event_results(event))
+        context['can_edit'] = can_edit(self.request, event)
         return context
 
 
-class OpeningDetail(generic.DetailView):
+class OpeningDetail(CachedDetailView):
     model = models.Opening
 
     def get_context_data(self, **kwargs):
         context = super(OpeningDetail, self).get_context_data(**kwargs)
         opening = context['opening']
-        context['opening_games'] = opening.games()[:50]
+        context['opening_games'] = opening.games().select_related(
+            *GAME_TABLE_RELATED)[:50]
+        context['results'] = SimpleLazyObject(
+            lambda: stats.opening_results(opening))
         context['variations'] = opening.variations()
         context['variation_of'] = opening.variation_of()
-        context['can_edit'] = can_edit(self.request.session, opening)
+        context['can_edit'] = can_edit(self.request, opening)
         return context
 
 
-# This is a big hack to get django to get django to do a weird join.
-# The problem is with queries like 'games where either player is ...'.
-# Such queries are best done with a single join :
-#   chs_game JOIN chs_player ON
-#   white_id = chs_player.object_id OR black_id = chs_player.object_id
-#
-# Unfortunaly, django is really not designed to do joins with strange
-# conditions, such as join conditions with an OR.
-# Equivalent queries that can easily be expressed through django are
-# heavily inefficient (~10 times slower during my tests).
-
-# This class is a hacked version of `django.db.models.sql.datastructures.Join`
-# which is used has a join descriptor by `django.db.models.sql.query.Query`.
-# It is responsible for producing the SQL code associated with the join,
-# making it easy to change in order to do a custom join condition.
-class PlayerLookupJoin(object):
-    def __init__(self, parent_alias, condition, params):
-        # Join table
-        self.table_name = 'chs_player'
-        self.parent_alias = parent_alias
-        # Note: table_alias is not necessarily known at instantiation time.
-        self.table_alias = None
-        # LOUTER or INNER
-        self.join_type = INNER
-        # Is this join nullabled?
-        self.nullable = False
-        # Custom join condition. Takes the table alias to use as parameters.
-        self.condition = condition
-        # parameters for join condition
-        self.params = params
-
-    def as_sql(self, compiler, connection):
-        qn = compiler.quote_name_unless_alias
-
-        condition = '%s.white_id = %s.object_id OR %s.black_id = %s.object_id'
-        condition = condition % (
-            qn(self.parent_alias),
-            qn(self.table_alias),
-            qn(self.parent_alias),
-            qn(self.table_alias),
+def filter_games(query):
+    """Games matching the filters of the game search form."""
+    def is_set(attr):
+        return attr in query and query[attr]
+
+    result = models.Game.objects.all()
+    if is_set('result'):
+        result = result.filter(result=query['result'])
+    if is_set('location'):
+        result = result.filter(location__chs_icontains=query['location'])
+    if is_set('event'):
+        result = result.filter(event__event_name__chs_icontains=query['event'])
+    if is_set('after'):
+        result = result.filter(start_date__gte=query['after'])
+    if is_set('before'):
+        result = result.filter(start_date__lte=query['before'])
+    if is_set('white'):
+        result = result.filter(
+            Q(white__lastname__chs_icontains=query['white'])
+            | Q(white__firstname__chs_icontains=query['white'])
         )
-
-        custom_condition = self.condition(qn(self.table_alias))
-        params = self.params
-
-        on_clause_sql = '(%s) AND (%s)' % (condition, custom_condition)
-
-        alias_str = '' if self.table_alias == self.table_name else (' %s' % self.table_alias)
-        sql = '%s %s%s ON (%s)' % (self.join_type, qn(self.table_name), alias_str, on_clause_sql)
-        return sql, params
-
-    def relabeled_clone(self, change_map):
-        new_parent_alias = change_map.get(self.parent_alias, self.parent_alias)
-        new_table_alias = change_map.get(self.table_alias, self.table_alias)
-        return self.__class__(
-            self.table_name, new_parent_alias, new_table_alias, self.join_type,
-            self.join_field, self.nullable)
-
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (
-                self.table_name == other.table_name and
-                self.parent_alias == other.parent_alias
+    if is_set('white_nat'):
+        result = result.filter(white__nationality=query['white_nat'])
+    if is_set('white_elo_min'):
+        result = result.filter(white__elo_rating__gte=query['white_elo_min'])
+    if is_set('white_elo_max'):
+        result = result.filter(white__elo_rating__lte=query['white_elo_max'])
+
+    if is_set('black'):
+        result = result.filter(
+            Q(black__lastname__chs_icontains=query['black'])
+            | Q(black__firstname__chs_icontains=query['black'])
+        )
+    if is_set('black_nat'):
+        result = result.filter(white__nationality=query['black_nat'])
+    if is_set('black_elo_min'):
+        result = result.filter(black__elo_rating__gte=query['black_elo_min'])
+    if is_set('black_elo_max'):
+        result = result.filter(black__elo_rating__lte=query['black_elo_max'])
+
+    if is_set('opening'):
+        try:
+            opening = models.Opening.objects.get(
+                opening_name=query['opening']
             )
-        return False
-
-    def demote(self):
-        new = self.relabeled_clone({})
-        new.join_type = INNER
-        return new
-
-    def promote(self):
-        new = self.relabeled_clone({})
-        new.join_type = LOUTER
-        return new
+            result = result.filter(opening__path__startswith=opening.path)
+        except models.Opening.DoesNotExist:
+            result = models.Game.objects.none()
+    if is_set('moves'):
+        if is_set('transpositions'):
+            try:
+                board = pgn.parse_position(query['moves'])
+                result = result & models.games_reaching(board)
+            except ValueError:
+                result = models.Game.objects.none()
+        else:
+            moves = pgn.encode_moves_from_uci(query['moves'].split(','))
+            result = result.filter(moves__chs_startswith=moves)
+    if is_set('position'):
+        try:
+            board = pgn.parse_position(query['position'])
+            result = result & models.games_reaching(board)
+        except ValueError:
+            result = models.Game.objects.none()
+
+    # Player conditions apply to the same side of the game.
+    sides = models.GameSide.objects.all()
+    if is_set('player'):
+        sides = sides.filter(
+            Q(lastname__iexact=query['player'])
+            | Q(firstname__iexact=query['player'])
+        )
+    if is_set('player_nat'):
+        sides = sides.filter(nationality=query['player_nat'])
+    if is_set('player_elo_min'):
+        sides = sides.filter(elo_rating__gte=query['player_elo_min'])
+    if is_set('player_elo_max'):
+        sides = sides.filter(elo_rating__lte=query['player_elo_max'])
+    if any(is_set(attr) for attr in (
+            'player', 'player_nat', 'player_elo_min', 'player_elo_max')):
+        result = result.filter(object_id__in=sides.values('game_id'))
+    return result
 
 
 class GameList(PaginatedListView):
     paginate_by = 50
+    keyset_field = 'start_date'
     context_object_name = "game_list"
 
     def get_queryset(self):
-        query = self.request.GET
-
-        def is_set(attr):
-            return attr in query and query[attr]
-
-        result = models.Game.objects.all()
-        if is_set('result'):
-            result = result.filter(result=query['result'])
-        if is_set('location'):
-            result = result.filter(location__icontains=query['location'])
-        if is_set('event'):
-            result = result.filter(event__event_name__icontains=query['event'])
-        if is_set('after'):
-            result = result.filter(start_date__gte=query['after'])
-        if is_set('before'):
-            result = result.filter(start_date__lte=query['before'])
-        if is_set('white'):
-            result = result.filter(
-                Q(white__lastname__icontains=query['white'])
-                | Q(white__firstname__icontains=query['white'])
-            )
-        if is_set('white_nat'):
-            result = result.filter(white__nationality=query['white_nat'])
-        if is_set('white_elo_min'):
-            result = result.filter(white__elo_rating__gte=query['white_elo_min'])
-        if is_set('white_elo_max'):
-            result = result.filter(white__elo_rating__lte=query['white_elo_max'])
-
-        if is_set('black'):
-            result = result.filter(
-                Q(black__lastname__icontains=query['black'])
-                | Q(black__firstname__icontains=query['black'])
-            )
-        if is_set('black_nat'):
-            result = result.filter(white__nationality=query['black_nat'])
-        if is_set('black_elo_min'):
-            result = result.filter(black__elo_rating__gte=query['black_elo_min'])
-        if is_set('black_elo_max'):
-            result = result.filter(black__elo_rating__lte=query['black_elo_max'])
-
-        if is_set('opening'):
-            try:
-                opening = models.Opening.objects.get(
-                    opening_name=query['opening']
-                )
-                result = result.filter(moves__chs_startswith=opening.moves)
-            except models.Opening.DoesNotExist:
-                result = models.Game.objects.none()
-        if is_set('moves'):
-            moves = pgn.encode_moves_from_uci(query['moves'].split(','))
-            result = result.filter(moves__chs_startswith=moves)
-
-        if is_set('player'):
-            def condition(table):
-                sql = 'UPPER(%s.lastname) = UPPER(%s) OR UPPER(%s.firstname) = UPPER(%s)'
-                return sql % (table, '%s', table, '%s')
-
-            join = PlayerLookupJoin(
-                result.query.get_initial_alias(),
-                condition,
-                [query['player'], query['player']]
-            )
-            result.query.join(join, [])
-        if is_set('player_nat'):
-            def condition(table):
-                sql = '%s.nationality = %s'
-                return sql % (table, '%s')
-
-            join = PlayerLookupJoin(
-                result.query.get_initial_alias(),
-                condition,
-                [query['player_nat']]
-            )
-            result.query.join(join, [])
-        if is_set('player_elo_min'):
-            def condition(table):
-                sql = '%s.elo_rating >= %s'
-                return sql % (table, '%s')
-
-            join = PlayerLookupJoin(
-                result.query.get_initial_alias(),
-                condition,
-                [query['player_elo_min']]
-            )
-            result.query.join(join, [])
-        if is_set('player_elo_max'):
-            def condition(table):
-                sql = '%s.elo_rating <= %s'
-                return sql % (table, '%s')
-
-            join = PlayerLookupJoin(
-                result.query.get_initial_alias(),
-                condition,
-                [query['player_elo_max']]
-            )
-            result.query.join(join, [])
-        return result.order_by('start_date')
+        return filter_games(self.request.GET).order_by(
+            'start_date', 'pk').select_related(*GAME_TABLE_RELATED)
+
+    def statistics_key(self):
+        """Cache key of the statistics of the current filters."""
+        query = sorted(
+            (key, value) for key, values in self.request.GET.lists()
+            if key not in ('page', 'after_key', 'before_key')
+            for value in values if value
+        )
+        digest = hashlib.sha1(repr(query).encode()).hexdigest()
+        return "chs:game_stats:{}:{}".format(models.games_generation(), digest)
+
+    def statistics(self, queryset):
+        """Result statistics of the listed games, cached per filter set."""
+        if getattr(self, '_statistics', None) is None:
+            key = self.statistics_key()
+            self._statistics = cache.get(key)
+            if self._statistics is None:
+                self._statistics = game_statistics(queryset)
+                cache.set(key, self._statistics)
+        return self._statistics
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return CountedPaginator(
+            queryset, per_page, self.statistics(queryset)['games'], **kwargs)
 
     def get_context_data(self, **kwargs):
         context = super(GameList, self).get_context_data(**kwargs)
-        queryset = self.get_queryset()
-        games = queryset.count()
-        white = queryset.filter(result='1-0').count()
-        black = queryset.filter(result='0-1').count()
-        draws = queryset.filter(result='1/2-1/2').count()
+        stats = self.statistics(self.object_list)
+        games = stats['games']
+        white = stats['white']
+        black = stats['black']
+        draws = stats['draws']
         context['game_number'] = games
         context['white_wins'] = white
         context['black_wins'] = black
@@ -295,6 +442,7 @@ class GameList(PaginatedListView):
 
 class PlayerList(PaginatedListView):
     paginate_by = 50
+    keyset_field = 'lastname'
 
     def get_queryset(self):
         query = self.request.GET
@@ -303,21 +451,26 @@ class PlayerList(PaginatedListView):
             return attr in query and query[attr]
 
         result = models.Player.objects
-        if is_set('name'):
+        if is_set('name') and is_set('fuzzy'):
             result = result.filter(
-                Q(firstname__icontains=query['name'])
-                | Q(lastname__icontains=query['name']))
+                Q(firstname__chs_similar=query['name'])
+                | Q(lastname__chs_similar=query['name']))
+        elif is_set('name'):
+            result = result.filter(
+                Q(firstname__chs_icontains=query['name'])
+                | Q(lastname__chs_icontains=query['name']))
         if is_set('elo_min'):
             result = result.filter(elo_rating__gte=query['elo_min'])
         if is_set('elo_max'):
             result = result.filter(elo_rating__lte=query['elo_max'])
         if is_set('nationality'):
             result = result.filter(nationality=query['nationality'])
-        return result.order_by('lastname')
+        return result.order_by('lastname', 'pk')
 
 
 class EventList(PaginatedListView):
     paginate_by = 50
+    keyset_field = 'start_date'
 
     def get_queryset(self):
         query = self.request.GET
@@ -327,14 +480,14 @@ class EventList(PaginatedListView):
 
         result = models.Event.objects
         if is_set('name'):
-            result = result.filter(event_name__icontains=query['name'])
+            result = result.filter(event_name__chs_icontains=query['name'])
         if is_set('location'):
-            result = result.filter(location__icontains=query['location'])
+            result = result.filter(location__chs_icontains=query['location'])
         if is_set('after'):
             result = result.filter(start_date__gte=query['after'])
         if is_set('before'):
             result = result.filter(start_date__lte=query['before'])
-        return result.order_by('start_date')
+        return result.order_by('start_date', 'pk')
 
 
 class OpeningList(PaginatedListView):
@@ -349,8 +502,53 @@ class OpeningList(PaginatedListView):
         result = models.Opening.objects
         if is_set('name'):
             result = result.filter(opening_name__icontains=query['name'])
+        if is_set('tree'):
+            return result.order_by('path')
         return result.order_by('opening_name')
 
+    def get_context_data(self, **kwargs):
+        context = super(OpeningList, self).get_context_data(**kwargs)
+        context['tree'] = bool(self.request.GET.get('tree'))
+        return context
+
+
+def export_games(request):
+    """Download the games of a search as a pgn file.
+
+    Games are read with a server side cursor and written as they come, so
+    that large exports run in constant memory.
+    """
+    games = filter_games(request.GET).order_by(
+            'start_date', 'pk'
+        ).select_related(*GAME_TABLE_RELATED)
+    response = StreamingHttpResponse(
+        (pgn.game_pgn(game) for game in games.iterator()),
+        content_type="application/x-chess-pgn"
+    )
+    response['Content-Disposition'] = 'attachment; filename="games.pgn"'
+    return response
+
+
+def explore(request):
+    """Continuations of a moves prefix, with their results, as JSON."""
+    moves = request.GET.get('moves', "")
+    try:
+        continuations = explorer.explore(moves.split(',') if moves else [])
+    except ValueError:
+        return JsonResponse({'error': "invalid moves"}, status=400)
+    return JsonResponse({'moves': continuations})
+
+
+def export_metrics(request):
+    """Request metrics of this process, in the Prometheus text format.
+
+    Only served to the addresses of the CHS_METRICS_ALLOWED_IPS setting.
+    """
+    allowed = getattr(settings, 'CHS_METRICS_ALLOWED_IPS', ())
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        raise Http404("Requested page does not exists")
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 
 def search_game(request):
     return render(request, 'chs/game_search.html')
@@ -385,7 +583,8 @@ def create_opening(request):
 
 
 def edit_game(request, pk):
-    game = get_object_or_404(models.Game, object_id=pk)
+    game = get_object_or_404(
+        models.Game.objects.select_related(*GAME_TABLE_RELATED), object_id=pk)
     return render(request, 'chs/game_create.html', {'game': game})
 
 
@@ -404,22 +603,29 @@ def edit_opening(request, pk):
     return render(request, 'chs/opening_create.html', {'opening': opening})
 
 
+@transaction.atomic
 def add_game(request):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
     if 'id' in request.POST and request.POST['id']:
-        game = get_object_or_404(models.Game, object_id=request.POST['id'])
+        game = get_object_or_404(
+            models.Game.objects.select_related('object'), object_id=request.POST['id'])
         if not account.has_edit_rights(game):
             return render(request, 'chs/error.html', {
                 'error': "you can not edit this object"
             })
+        old_games = [(game.moves, game.result)]
+        old_results = [stats.game_key(game)]
+        stale = models.related_ids(models.Game.objects.filter(pk=game.pk))
     else:
-        obj = models.create_obj(account)
+        obj = models.create_obj(account, models.Object.GAME)
         game = models.Game(object=obj)
+        old_games = []
+        old_results = []
+        stale = set()
 
     if not (request.POST['moves'] and request.POST['result']):
         return render(request, 'chs/error.html', {
@@ -452,14 +658,23 @@ def add_game(request):
     else:
         game.black = None
 
+    game.opening = models.deepest_opening(game.moves)
     game.save()
+    models.index_positions(game)
+    models.refresh_game_sides(game)
+    explorer.record_games(old_games, -1)
+    explorer.record_games([(game.moves, game.result)])
+    stats.record_games(old_results, -1)
+    stats.record_games([stats.game_key(game)])
+    stale |= models.related_ids(models.Game.objects.filter(pk=game.pk))
+    models.bump_versions(stale)
+    models.games_changed()
     return HttpResponseRedirect(reverse('chess:game_list'))
 
 
 def add_game_pgn(request):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
@@ -472,20 +687,20 @@ def add_game_pgn(request):
 
 
 def add_player(request):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
     if 'id' in request.POST and request.POST['id']:
-        player = get_object_or_404(models.Player, object_id=request.POST['id'])
+        player = get_object_or_404(
+            models.Player.objects.select_related('object'), object_id=request.POST['id'])
         if not account.has_edit_rights(player):
             return render(request, 'chs/error.html', {
                 'error': "you can not edit this object"
             })
     else:
-        obj = models.create_obj(account)
+        obj = models.create_obj(account, models.Object.PLAYER)
         player = models.Player(object=obj)
 
     player.firstname = request.POST.get('firstname', "")
@@ -498,24 +713,28 @@ def add_player(request):
         player.nationality = None
 
     player.save()
+    models.refresh_player_sides(player)
+    models.bump_versions(
+        models.related_ids(player.games()) | {player.object_id})
+    models.games_changed()
     return HttpResponseRedirect(reverse('chess:player_list'))
 
 
 def add_event(request):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
     if 'id' in request.POST and request.POST['id']:
-        event = get_object_or_404(models.Event, object_id=request.POST['id'])
+        event = get_object_or_404(
+            models.Event.objects.select_related('object'), object_id=request.POST['id'])
         if not account.has_edit_rights(event):
             return render(request, 'chs/error.html', {
                 'error': "you can not edit this object"
             })
     else:
-        obj = models.create_obj(account)
+        obj = models.create_obj(account, models.Object.EVENT)
         event = models.Event(object=obj)
 
     event.event_name = request.POST['event_name']
@@ -530,27 +749,32 @@ def add_event(request):
         event.end_date = None
 
     event.save()
+    models.bump_versions(models.related_ids(event.games()) | {event.object_id})
+    models.games_changed()
     return HttpResponseRedirect(reverse('chess:event_list'))
 
 
+@transaction.atomic
 def add_opening(request):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
     if 'id' in request.POST and request.POST['id']:
-        opening = get_object_or_404(models.Opening, object_id=request.POST['id'])
+        opening = get_object_or_404(
+            models.Opening.objects.select_related('object'), object_id=request.POST['id'])
         if not account.has_edit_rights(opening):
             return render(request, 'chs/error.html', {
                 'error': "you can not edit this object"
             })
         new = False
+        stale = opening.related_ids()
     else:
-        obj = models.create_obj(account)
+        obj = models.create_obj(account, models.Object.OPENING)
         opening = models.Opening(object=obj)
         new = True
+        stale = set()
 
     if not (request.POST['moves']):
         return render(request, 'chs/error.html', {
@@ -568,92 +792,113 @@ def add_opening(request):
         })
 
     opening.save()
+    models.rebuild_opening_tree()
+    opening.refresh_from_db()
+    if not new:
+        moved = models.reclassify_opening_games(opening)
+        stale |= models.related_ids(
+            models.Game.objects.filter(object_id__in=moved))
+    models.classify_opening(opening)
+    models.bump_versions(stale | opening.related_ids())
     return HttpResponseRedirect(reverse('chess:opening_list'))
 
 
+@transaction.atomic
 def delete_game(request, pk):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
-    game = get_object_or_404(models.Game, object_id=pk)
+    game = get_object_or_404(
+        models.Game.objects.select_related('object'), object_id=pk)
     if not account.has_edit_rights(game):
         return render(request, 'chs/error.html', {
             'error': "you can not delete this object"
         })
+    explorer.record_games([(game.moves, game.result)], -1)
+    stats.record_games([stats.game_key(game)], -1)
+    models.bump_versions(models.related_ids(models.Game.objects.filter(pk=game.pk)))
+    models.games_changed()
     game.delete()
     return HttpResponseRedirect(reverse('chess:game_list'))
 
 
 def delete_player(request, pk):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
-    player = get_object_or_404(models.Player, object_id=pk)
+    player = get_object_or_404(
+        models.Player.objects.select_related('object'), object_id=pk)
     if not account.has_edit_rights(player):
         return render(request, 'chs/error.html', {
             'error': "you can not delete this object"
         })
+    models.bump_versions(models.related_ids(player.games()))
+    models.games_changed()
     player.delete()
     return HttpResponseRedirect(reverse('chess:player_list'))
 
 
 def delete_event(request, pk):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
-    event = get_object_or_404(models.Event, object_id=pk)
+    event = get_object_or_404(
+        models.Event.objects.select_related('object'), object_id=pk)
     if not account.has_edit_rights(event):
         return render(request, 'chs/error.html', {
             'error': "you can not delete this object"
         })
+    models.bump_versions(models.related_ids(event.games()))
+    models.games_changed()
     event.delete()
     return HttpResponseRedirect(reverse('chess:event_list'))
 
 
+@transaction.atomic
 def delete_opening(request, pk):
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
-    opening = get_object_or_404(models.Opening, object_id=pk)
+    opening = get_object_or_404(
+        models.Opening.objects.select_related('object'), object_id=pk)
     if not account.has_edit_rights(opening):
         return render(request, 'chs/error.html', {
             'error': "you can not delete this object"
         })
+    stale = opening.related_ids()
     opening.delete()
+    models.bump_versions(stale)
     return HttpResponseRedirect(reverse('chess:opening_list'))
 
 
+# Detail page of each kind of object.
+OBJECT_URLS = {
+    models.Object.GAME: 'chess:game',
+    models.Object.PLAYER: 'chess:player',
+    models.Object.EVENT: 'chess:event',
+    models.Object.OPENING: 'chess:opening',
+}
+
+
 def object(request, pk):
-    obj = get_object_or_404(models.Object, id=pk)
-    if models.Game.objects.filter(object=obj).exists():
-        return HttpResponseRedirect(reverse('chess:game', args=(obj.id,)))
-    elif models.Player.objects.filter(object=pk).exists():
-        return HttpResponseRedirect(reverse('chess:player', args=(obj.id,)))
-    elif models.Event.objects.filter(object=pk).exists():
-        return HttpResponseRedirect(reverse('chess:event', args=(obj.id,)))
-    elif models.Opening.objects.filter(object=pk).exists():
-        return HttpResponseRedirect(reverse('chess:opening', args=(obj.id,)))
-    else:
+    obj = get_object_or_404(models.Object.objects.only('kind'), id=pk)
+    if obj.kind not in OBJECT_URLS:
         raise Http404("Requested object does not exists")
+    return HttpResponseRedirect(reverse(OBJECT_URLS[obj.kind], args=(obj.id,)))
 
 
 def comment(request, pk):
     obj = get_object_or_404(models.Object, id=pk)
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except (KeyError, models.Account.DoesNotExist):
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "incorrect login informations"
         })
@@ -661,6 +906,7 @@ def comment(request, pk):
                              object=obj,
                              text=request.POST['comment_text'])
     comment.save()
+    models.bump_versions([obj.id])
     return HttpResponseRedirect(reverse('chess:object', args=(obj.id,)))
 
 
@@ -754,16 +1000,11 @@ def account(request):
 
 
 def change_password(request):
-    if not request.session['account']:
+    account = request.account
+    if account is None:
         return render(request, 'chs/error.html', {
             'error': "You are not logged in"
         })
-    try:
-        account = models.Account.objects.get(id=request.session['account'])
-    except models.Account.DoesNotExist:
-        return render(request, 'chs/error.html', {
-            'error': "incorrect account informations"
-        })
 
     if not request.POST['old_password'] or not request.POST['password']:
         return render(request, 'chs/account.html', {